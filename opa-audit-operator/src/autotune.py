@@ -0,0 +1,93 @@
+"""Adaptive audit-chunk-size and audit-interval from observed audit cost."""
+
+import logging
+import math
+from typing import Dict, NamedTuple, Optional
+from urllib.error import URLError
+from urllib.request import urlopen
+
+log = logging.getLogger(__name__)
+
+METRICS_URL = "http://localhost:8888/metrics"
+
+# Shrink the chunk size above this share of the memory limit and grow it below
+# the lower one, leaving a band in between where it is kept as is.
+MEMORY_HIGH = 0.8
+MEMORY_LOW = 0.5
+CHUNK_SHRINK = 0.5
+CHUNK_GROW = 1.25
+
+
+class AuditBounds(NamedTuple):
+    chunk_size_min: int
+    chunk_size_max: int
+    interval_min: int
+    interval_max: int
+    safety_factor: float
+    memory_limit: int
+
+
+class AuditObservation(NamedTuple):
+    runs: int
+    duration_total: float
+    last_run: float
+    memory: float
+
+
+def scrape_metrics(url=METRICS_URL, timeout=5) -> Dict[str, float]:
+    """Fetch a Prometheus endpoint and sum the samples of every metric name."""
+    with urlopen(url, timeout=timeout) as response:
+        text = response.read().decode()
+
+    samples: Dict[str, float] = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        series, _, value = line.rpartition(" ")
+        name = series.split("{", 1)[0]
+        try:
+            samples[name] = samples.get(name, 0.0) + float(value)
+        except ValueError:
+            continue
+    return samples
+
+
+def observe_audit(url=METRICS_URL) -> Optional[AuditObservation]:
+    """Read the audit cost from the workload, or None if it is unavailable."""
+    try:
+        samples = scrape_metrics(url)
+    except (URLError, OSError) as e:
+        log.warning(f"Failed to read audit metrics from {url}: {e}")
+        return None
+
+    if "gatekeeper_audit_duration_seconds_count" not in samples:
+        return None
+    return AuditObservation(
+        runs=int(samples["gatekeeper_audit_duration_seconds_count"]),
+        duration_total=samples.get("gatekeeper_audit_duration_seconds_sum", 0.0),
+        last_run=samples.get("gatekeeper_audit_last_run_time", 0.0),
+        memory=samples.get("process_resident_memory_bytes", 0.0),
+    )
+
+
+def tune_chunk_size(chunk_size: int, memory: float, bounds: AuditBounds) -> int:
+    """Shrink the chunk size when memory is tight, grow it when memory is plentiful.
+
+    Larger chunks mean fewer list round-trips to the API server per audit, so the
+    chunk size grows as long as the audit has memory to spare. A chunk size of 0
+    (unlimited) is kept, and so is any chunk size when the memory is unknown.
+    """
+    if not chunk_size or not memory:
+        return chunk_size
+    ratio = memory / bounds.memory_limit
+    if ratio >= MEMORY_HIGH:
+        chunk_size = math.floor(chunk_size * CHUNK_SHRINK)
+    elif ratio < MEMORY_LOW:
+        chunk_size = math.ceil(chunk_size * CHUNK_GROW)
+    return max(bounds.chunk_size_min, min(bounds.chunk_size_max, chunk_size))
+
+
+def tune_interval(duration: float, bounds: AuditBounds) -> int:
+    """Never schedule audits more often than the duration times the safety factor."""
+    interval = math.ceil(duration * bounds.safety_factor)
+    return max(bounds.interval_min, min(bounds.interval_max, interval))
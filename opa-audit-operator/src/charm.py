@@ -1,28 +1,58 @@
 #!/usr/bin/env python3
+"""Juju charm of the gatekeeper audit.
+
+Juju runs this module for every hook and action, so only what every dispatch
+needs is imported here. lightkube, ops.manifests and the charm libraries take
+most of the startup time, and are imported by the handlers using them.
+"""
+
 import json
 import logging
+import os
+import re
+from functools import cached_property
+from urllib.error import URLError
 
-from charms.observability_libs.v1.kubernetes_service_patch import KubernetesServicePatch
-from charms.prometheus_k8s.v0.prometheus_scrape import MetricsEndpointProvider
-from lightkube import Client
-from lightkube.generic_resource import (
-    get_generic_resource,
-    load_in_cluster_generic_resources,
-)
-from lightkube.models.core_v1 import ServicePort
-from lightkube.resources.apps_v1 import StatefulSet
-from ops.charm import CharmBase
+from ops.charm import CharmBase, CharmEvents
+from ops.framework import EventSource, StoredState
 from ops.main import main
-from ops.manifests import Collector, ManifestClientError
 from ops.model import ActiveStatus, BlockedStatus, ModelError, WaitingStatus
 from ops.pebble import Error as PebbleError
 from ops.pebble import ServiceStatus
 
-from manifests import ControllerManagerManifests
+import external_data
+from autotune import AuditBounds, observe_audit, tune_chunk_size, tune_interval
+from charm_metrics import EXPORTER_PORT, METRICS_PATH, CharmMetrics
+from drift_watcher import DriftWatcher, ResourcesChangedEvent
+from placement import pod_placement
+from ratelimit import RateLimiter
+from retry import retry
+from shared_resources import SharedResources
 
 logger = logging.getLogger(__name__)
 
-scrape_config = [{"static_configs": [{"targets": ["*:8888"]}]}]
+# A Prometheus duration, e.g. 30s or 1m30s
+PROMETHEUS_DURATION = re.compile(r"^((\d+)(y|w|d|h|m|s|ms))+$")
+
+# Dispatches which the scrape job and service patch libraries don't observe,
+# where they aren't imported
+WITHOUT_LIBS = ("hooks/update-status", "actions/")
+
+# The options audit-autotune starts tuning over from when they change
+AUTOTUNE_OPTIONS = (
+    "audit-autotune",
+    "audit-chunk-size",
+    "audit-interval",
+    "audit-chunk-size-min",
+    "audit-chunk-size-max",
+    "audit-interval-max",
+    "audit-interval-safety-factor",
+    "audit-memory-limit",
+)
+
+
+class GatekeeperCharmEvents(CharmEvents):
+    resources_changed = EventSource(ResourcesChangedEvent)
 
 
 class OPAAuditCharm(CharmBase):
@@ -31,28 +61,56 @@ class OPAAuditCharm(CharmBase):
     """
 
     _GATEKEEPER_CONTAINER_NAME = "gatekeeper"
+    _stored = StoredState()
+    on = GatekeeperCharmEvents()
 
     def __init__(self, *args):
         super().__init__(*args)
-
-        self.metrics_endpoint = MetricsEndpointProvider(
-            self, "metrics-endpoint", jobs=scrape_config
+        self._stored.set_default(
+            audit_chunk_size=None,
+            audit_interval=None,
+            audit_tuned_config=None,
+            audit_last_run=0.0,
+            audit_runs=0,
+            audit_duration_total=0.0,
+            manifest_hashes=None,
+            statefulset_patch=None,
+            live_pods=None,
         )
-        metrics = ServicePort(8888, protocol="TCP", name="metrics")
-        self.service_patcher = KubernetesServicePatch(self, [metrics])
-
-        self.manifests = ControllerManagerManifests(self, self.config)
-        self.collector = Collector(self.manifests)
 
-        self.client = Client(field_manager=self.app.name, namespace=self.model.name)
+        self.charm_metrics = CharmMetrics(self)
+        self.rate_limiter = RateLimiter(
+            self.config["api-qps"], self.config["api-burst"], self.charm_metrics
+        )
+        if not os.environ.get("JUJU_DISPATCH_PATH", "").startswith(WITHOUT_LIBS):
+            self._observe_with_libs()
+
+        self.shared_resources = SharedResources(
+            self,
+            "gatekeeper-shared",
+            owner=False,
+            contributions=self._shared_contributions,
+        )
+        self.drift_watcher = DriftWatcher(self, self.charm_dir.parent)
+        self._deleted_pod_statuses = 0
 
         self.framework.observe(self.on.install, self._install_or_upgrade)
         self.framework.observe(self.on.upgrade_charm, self._install_or_upgrade)
+        self.framework.observe(self.on.leader_elected, self._on_leader_elected)
+        self.framework.observe(
+            self.on["gatekeeper-shared"].relation_changed, self._on_shared_owner_changed
+        )
+        self.framework.observe(
+            self.on["gatekeeper-shared"].relation_broken, self._on_shared_owner_changed
+        )
         self.framework.observe(
             self.on.gatekeeper_pebble_ready, self._on_gatekeeper_pebble_ready
         )
         self.framework.observe(self.on.config_changed, self._on_config_changed)
+        self.framework.observe(self.on.update_status, self._autotune_audit)
+        self.framework.observe(self.on.update_status, self._collect_pod_statuses)
         self.framework.observe(self.on.update_status, self._on_update_status)
+        self.framework.observe(self.on.resources_changed, self._on_update_status)
 
         # Template-related actions
         self.framework.observe(self.on.list_constraints_action, self._list_constraints)
@@ -60,6 +118,9 @@ class OPAAuditCharm(CharmBase):
         self.framework.observe(self.on.get_violation_action, self._get_violation)
 
         # Manifest-related actions
+        self.framework.observe(
+            self.on.check_external_data_action, self._check_external_data
+        )
         self.framework.observe(self.on.list_resources_action, self._list_resources)
         self.framework.observe(self.on.list_versions_action, self._list_versions)
         self.framework.observe(
@@ -68,6 +129,64 @@ class OPAAuditCharm(CharmBase):
 
         self.framework.observe(self.on.remove, self._cleanup)
 
+    def _observe_with_libs(self):
+        from charms.observability_libs.v1.kubernetes_service_patch import (
+            KubernetesServicePatch,
+        )
+        from charms.prometheus_k8s.v0.prometheus_scrape import MetricsEndpointProvider
+        from lightkube.models.core_v1 import ServicePort
+
+        self.metrics_endpoint = MetricsEndpointProvider(
+            self,
+            "metrics-endpoint",
+            jobs=self._scrape_config,
+            refresh_event=self.on.gatekeeper_pebble_ready,
+        )
+        # the library drops the metric relabelling from the jobs it publishes,
+        # so they are published again after it
+        endpoint = self.on["metrics-endpoint"]
+        for event in (
+            endpoint.relation_joined,
+            endpoint.relation_changed,
+            self.on.leader_elected,
+            self.on.upgrade_charm,
+        ):
+            self.framework.observe(event, self._publish_scrape_jobs)
+        metrics = ServicePort(8888, protocol="TCP", name="metrics")
+        charm_metrics = ServicePort(EXPORTER_PORT, protocol="TCP", name="charm-metrics")
+        self.service_patcher = KubernetesServicePatch(self, [metrics, charm_metrics])
+
+    @cached_property
+    def client(self):
+        """Lightkube client, rate limited and counted."""
+        from lightkube import Client
+
+        return self.instrument_client(
+            Client(field_manager=self.app.name, namespace=self.model.name)
+        )
+
+    @cached_property
+    def manifests(self):
+        from manifests import ControllerManagerManifests
+
+        return ControllerManagerManifests(self, self.config)
+
+    @cached_property
+    def collector(self):
+        from ops.manifests import Collector
+
+        return Collector(self.manifests)
+
+    def _shared_contributions(self):
+        """Settings of this charm which the owner of the shared resources applies."""
+        providers = self.config["external-data-providers"]
+        return {
+            "match-exclusions": self.config["match-exclusions"],
+            "external-data-providers": (
+                providers if self.config["external-data"] else ""
+            ),
+        }
+
     @property
     def is_running(self):
         """Determine if a given service is running in a given container"""
@@ -82,6 +201,81 @@ class OPAAuditCharm(CharmBase):
     def pod_name(self):
         return "-".join(self.unit.name.rsplit("/"))
 
+    def _workload_release(self):
+        """The release in the tag of the gatekeeper image the pod runs, e.g. v3.11.0.
+
+        Juju doesn't tell the charm the image of its resources, so it's read
+        from the pod.
+        """
+        from lightkube import ApiError
+        from lightkube.resources.core_v1 import Pod
+
+        try:
+            pod = self.client.get(Pod, self.pod_name, namespace=self.model.name)
+        except ApiError:
+            logger.exception("Failed to read the gatekeeper image")
+            return None
+        for container in pod.spec.containers:
+            if container.name == self._GATEKEEPER_CONTAINER_NAME:
+                return external_data.image_release(container.image)
+        return None
+
+    def instrument_client(self, client):
+        """Rate limit a lightkube client and count the API requests made with it."""
+        return self.charm_metrics.instrument(self.rate_limiter.wrap(client))
+
+    @property
+    def _scrape_config(self):
+        """Scrape job for the gatekeeper metrics endpoint, limited by charm config."""
+        job = {"metrics_path": "/metrics", "static_configs": [{"targets": ["*:8888"]}]}
+        for key in ("scrape_interval", "scrape_timeout"):
+            option = "metrics-" + key.replace("_", "-")
+            if not (value := self.config.get(option)):
+                continue
+            if not PROMETHEUS_DURATION.match(value):
+                logger.error(f"Ignoring {option}={value}: not a Prometheus duration")
+                continue
+            job[key] = value
+
+        metric_relabel_configs = []
+        if keep := self.config.get("metrics-keep"):
+            metric_relabel_configs.append(
+                {"source_labels": ["__name__"], "regex": keep, "action": "keep"}
+            )
+        if drop := self.config.get("metrics-drop"):
+            metric_relabel_configs.append(
+                {"source_labels": ["__name__"], "regex": drop, "action": "drop"}
+            )
+        if metric_relabel_configs:
+            job["metric_relabel_configs"] = metric_relabel_configs
+
+        charm_job = {
+            "job_name": "charm",
+            "metrics_path": METRICS_PATH,
+            "static_configs": [{"targets": [f"*:{EXPORTER_PORT}"]}],
+        }
+        return [job, charm_job]
+
+    @property
+    def _audit_chunk_size(self):
+        if self.config["audit-autotune"] and self._stored.audit_chunk_size:
+            return self._stored.audit_chunk_size
+        return self.config["audit-chunk-size"]
+
+    @property
+    def _audit_interval(self):
+        if self.config["audit-autotune"] and self._stored.audit_interval is not None:
+            return self._stored.audit_interval
+        return self.config["audit-interval"]
+
+    def _publish_scrape_jobs(self, _event):
+        """Publish the scrape jobs of the current config to Prometheus."""
+        if not self.unit.is_leader():
+            return
+        jobs = json.dumps(self._scrape_config)
+        for relation in self.model.relations["metrics-endpoint"]:
+            relation.data[self.app]["scrape_jobs"] = jobs
+
     def _gatekeeper_layer(self):
         return {
             "summary": "Gatekeeper layer",
@@ -98,8 +292,9 @@ class OPAAuditCharm(CharmBase):
                     "--disable-opa-builtin={http.send} "
                     "--disable-cert-rotation "
                     f"--constraint-violations-limit={self.config['constraint-violations-limit']} "
-                    f"--audit-chunk-size={self.config['audit-chunk-size']} "
-                    f"--audit-interval={self.config['audit-interval']} "
+                    f"--audit-chunk-size={self._audit_chunk_size} "
+                    f"--audit-interval={self._audit_interval} "
+                    f"{external_data.flags(self.config, self._workload_release)}"
                     f"--log-level {self.config['log-level']}",
                     "startup": "enabled",
                     "environment": {
@@ -132,13 +327,30 @@ class OPAAuditCharm(CharmBase):
         if not self.unit.is_leader():
             return
         logger.info("Installing manifest resources ...")
-        try:
-            self.manifests.apply_manifests()
-        except ManifestClientError():
-            self.unit.status = WaitingStatus("Waiting kube-apiserver")
+
+        def apply_manifests():
+            self._stored.manifest_hashes = self.manifests.apply_manifests(
+                self._stored.manifest_hashes
+            )
+
+        if not retry(apply_manifests, self.config["api-retry-budget"]):
+            self.charm_metrics.count_deferred("ManifestClientError")
+            self.unit.status = WaitingStatus("Waiting for kube-apiserver")
             event.defer()
             return
 
+    def _on_leader_elected(self, _event):
+        # another leader may have applied other manifests since this unit did
+        self._stored.manifest_hashes = None
+        self._stored.statefulset_patch = None
+        self._stored.live_pods = None
+
+    def _on_shared_owner_changed(self, event):
+        # re-apply everything this charm now owns, e.g. to take over the shared
+        # resources once the related charm no longer owns them
+        self._stored.manifest_hashes = None
+        self._install_or_upgrade(event)
+
     def _on_gatekeeper_pebble_ready(self, event):
         if self.is_running:
             logger.info("Gatekeeper already started")
@@ -152,43 +364,198 @@ class OPAAuditCharm(CharmBase):
         self._on_update_status(event)
 
     def _on_config_changed(self, event):
+        self._publish_scrape_jobs(event)
+        # start tuning over from the configured values when the tuning options
+        # change, not on every config-changed, e.g. after a pod restart
+        tuned_config = {option: self.config[option] for option in AUTOTUNE_OPTIONS}
+        if tuned_config != self._stored.audit_tuned_config:
+            self._stored.audit_tuned_config = tuned_config
+            self._stored.audit_chunk_size = None
+            self._stored.audit_interval = None
+        # only the resources whose content depends on the changed config are applied
+        self._install_or_upgrade(event)
+        self._patch_statefulset()
+
         if not self.is_running:
             logger.info("Gatekeeper is not running")
             return
 
         container = self.unit.get_container(self._GATEKEEPER_CONTAINER_NAME)
+        self._update_layer(container)
+        self._on_update_status(event)
+
+    def _update_layer(self, container):
+        """Apply the gatekeeper layer, restarting gatekeeper only if it needs to.
+
+        Gatekeeper reads its command line and environment only at startup, so
+        the service is restarted when either differs from the current plan.
+        Any other change, e.g. to the checks, is applied without a restart.
+
+        Returns:
+            True if the service was restarted.
+        """
         layer = self._gatekeeper_layer()
+        service = layer["services"][self._GATEKEEPER_CONTAINER_NAME]
+        current = container.get_plan().services.get(self._GATEKEEPER_CONTAINER_NAME)
         container.add_layer(self._GATEKEEPER_CONTAINER_NAME, layer, combine=True)
+        if (
+            current is not None
+            and current.command == service["command"]
+            and current.environment == service["environment"]
+        ):
+            logger.info("Gatekeeper service unchanged, not restarting")
+            return False
+
+        logger.info("Gatekeeper service changed, restarting")
         container.restart(self._GATEKEEPER_CONTAINER_NAME)
-        self._on_update_status(event)
+        return True
+
+    def _autotune_audit(self, event):
+        """Adapt audit-chunk-size and audit-interval to the observed audit cost."""
+        if not self.config["audit-autotune"] or not self.is_running:
+            return
+        if (observation := observe_audit()) is None:
+            return
+        if observation.last_run == self._stored.audit_last_run:
+            logger.debug("No audit finished since the last observation")
+            return
+
+        runs = observation.runs - self._stored.audit_runs
+        duration_total = observation.duration_total - self._stored.audit_duration_total
+        self._stored.audit_last_run = observation.last_run
+        self._stored.audit_runs = observation.runs
+        self._stored.audit_duration_total = observation.duration_total
+        if runs <= 0:
+            # the workload restarted and its counters were reset
+            return
+
+        bounds = AuditBounds(
+            chunk_size_min=self.config["audit-chunk-size-min"],
+            chunk_size_max=self.config["audit-chunk-size-max"],
+            interval_min=self.config["audit-interval"],
+            interval_max=self.config["audit-interval-max"],
+            safety_factor=self.config["audit-interval-safety-factor"],
+            memory_limit=self.config["audit-memory-limit"] * 2**20,
+        )
+        chunk_size = tune_chunk_size(self._audit_chunk_size, observation.memory, bounds)
+        interval = self._audit_interval
+        if interval:  # an interval of 0 disables periodic audits
+            interval = tune_interval(duration_total / runs, bounds)
+        if (chunk_size, interval) == (self._audit_chunk_size, self._audit_interval):
+            return
+
+        logger.info(
+            f"Tuning audit to chunk size {chunk_size} and interval {interval}s "
+            f"(mean duration {duration_total / runs:.1f}s, "
+            f"memory {observation.memory / 2**20:.0f}Mi)"
+        )
+        self._stored.audit_chunk_size = chunk_size
+        self._stored.audit_interval = interval
+        container = self.unit.get_container(self._GATEKEEPER_CONTAINER_NAME)
+        if self._update_layer(container):
+            # the restarted workload starts counting audits from scratch
+            self._stored.audit_runs = 0
+            self._stored.audit_duration_total = 0.0
 
     def _on_update_status(self, event):
         """Update Juju status"""
         logger.info("Update status")
         if not self.is_running:
             self.unit.status = WaitingStatus("Gatekeeper is not running")
-        elif self.manifests.resources != self.manifests.installed_resources():
+        elif self.manifests.resources != (
+            installed := self.manifests.installed_resources()
+        ):
             self.unit.status = BlockedStatus(
                 "Missing resources, to reconcile run: "
                 f"`juju run {self.unit.name} reconcile-resources`"
             )
+        elif self.manifests.drifted_resources(installed):
+            self.unit.status = BlockedStatus(
+                "Drifted resources, to reconcile run: "
+                f"`juju run {self.unit.name} reconcile-resources`"
+            )
+        elif missing_shared := self.manifests.missing_shared_resources():
+            owner = self.shared_resources.owned_elsewhere
+            self.unit.status = WaitingStatus(
+                f"Waiting for {owner} to install {len(missing_shared)} shared resources"
+            )
         elif unready := self.collector.unready:
             # Wait for all installed resource to be ready
             self.unit.status = WaitingStatus(", ".join(unready))
+        elif self._deleted_pod_statuses:
+            self.unit.status = ActiveStatus(
+                f"Deleted {self._deleted_pod_statuses} stale pod statuses"
+            )
         else:
             self.unit.status = ActiveStatus()
 
+    def _collect_pod_statuses(self, _event):
+        """Delete the pod status objects of the application's departed units."""
+        if not self.unit.is_leader():
+            return
+        from lightkube import ApiError
+
+        from pod_statuses import delete_stale_pod_statuses, live_pods
+
+        try:
+            live = live_pods(self.client, self.model.name, self.app.name)
+            if live == self._stored.live_pods:
+                # no pod went away since the last collection
+                return
+            self._deleted_pod_statuses = delete_stale_pod_statuses(
+                self.client, self.model.name, self.app.name, live
+            )
+            self._stored.live_pods = live
+        except ApiError:
+            logger.exception("Failed to delete stale pod statuses")
+
     def _cleanup(self, event):
         logger.info("Cleaning up manifest resources ...")
-        try:
+
+        def delete_manifests():
             self.manifests.delete_manifests(
                 ignore_unauthorized=True, ignore_not_found=True
             )
-        except ManifestClientError:
-            self.unit.status = WaitingStatus("Waiting kube-apiserver")
+
+        if not retry(delete_manifests, self.config["api-retry-budget"]):
+            self.charm_metrics.count_deferred("ManifestClientError")
+            self.unit.status = WaitingStatus("Waiting for kube-apiserver")
             event.defer()
             return
 
+    def _check_external_data(self, event):
+        """Query an external data provider the way gatekeeper does."""
+        providers = external_data.parse_providers(
+            self.config["external-data-providers"],
+            *self.shared_resources.contributed("external-data-providers"),
+        )
+        name = event.params["provider"]
+        if not (spec := providers.get(name)):
+            event.fail(f"Unknown external data provider {name}")
+            return
+        timeout = spec.get("timeout", self.config["external-data-timeout"])
+        try:
+            response, latency = external_data.query_provider(
+                spec, event.params["keys"].split(), timeout
+            )
+        except (URLError, OSError, ValueError) as e:
+            event.fail(f"Failed to query {name}: {e}")
+            return
+        if error := response.get("systemError"):
+            event.fail(f"{name} failed: {error}")
+            return
+        if not response.get("idempotent"):
+            event.log(
+                f"{name} responses aren't idempotent, gatekeeper won't cache them"
+            )
+        event.set_results(
+            {
+                "idempotent": bool(response.get("idempotent")),
+                "items": json.dumps(response.get("items") or []),
+                "latency": f"{latency:.3f}s",
+            }
+        )
+
     def _list_resources(self, event):
         return self.collector.list_resources(event, None, None)
 
@@ -196,9 +563,11 @@ class OPAAuditCharm(CharmBase):
         self.collector.list_versions(event)
 
     def _reconcile_resources(self, event):
+        from ops.manifests import ManifestClientError
+
         try:
             event.log("Reconciling resources")
-            self.collector.apply_missing_resources(event, None, None)
+            self._apply_stale_resources(event)
             event.log("Updating status")
             self._on_update_status(event)
         except ManifestClientError:
@@ -206,7 +575,34 @@ class OPAAuditCharm(CharmBase):
                 {"result": "Failed to reconcile. API server unavailable."}
             )
 
+    def _apply_stale_resources(self, event):
+        """Re-apply the resources which are missing or have drifted from the manifests."""
+        installed = self.manifests.installed_resources()
+        missing = [rsc for rsc in self.manifests.resources if rsc not in installed]
+        drifted = self.manifests.drifted_resources(installed)
+        for rsc, paths in drifted.items():
+            event.log(f"{rsc} drifted: {', '.join(paths)}")
+
+        if stale := [*missing, *drifted]:
+            event.log(f"Applying {', '.join(str(rsc) for rsc in stale)}")
+            self.manifests.apply_resources_parallel(*stale)
+
+        name = self.manifests.name
+        results = {
+            f"{name}-missing": "\n".join(sorted(str(rsc) for rsc in missing)),
+            f"{name}-drifted": "\n".join(
+                f"{rsc}: {', '.join(paths)}"
+                for rsc, paths in sorted(drifted.items(), key=lambda i: str(i[0]))
+            ),
+        }
+        event.set_results({key: value for key, value in results.items() if value})
+
     def _list_constraints(self, event):
+        from lightkube.generic_resource import (
+            get_generic_resource,
+            load_in_cluster_generic_resources,
+        )
+
         event.log("Fetching templates")
         load_in_cluster_generic_resources(self.client)
         ConstraintTemplate = get_generic_resource(
@@ -229,6 +625,11 @@ class OPAAuditCharm(CharmBase):
         event.set_results(constraints)
 
     def _list_violations(self, event):
+        from lightkube.generic_resource import (
+            get_generic_resource,
+            load_in_cluster_generic_resources,
+        )
+
         event.log("Fetching templates")
         load_in_cluster_generic_resources(self.client)
         ConstraintTemplate = get_generic_resource(
@@ -256,6 +657,11 @@ class OPAAuditCharm(CharmBase):
         event.set_results({"constraint-violations": json.dumps(ret, indent=2)})
 
     def _get_violation(self, event):
+        from lightkube.generic_resource import (
+            get_generic_resource,
+            load_in_cluster_generic_resources,
+        )
+
         load_in_cluster_generic_resources(self.client)
         constraint_template = event.params["constraint-template"]
         constraint = event.params["constraint"]
@@ -277,6 +683,10 @@ class OPAAuditCharm(CharmBase):
         """
         if not self.unit.is_leader():
             return
+        from lightkube.resources.apps_v1 import StatefulSet
+
+        from manifests import content_hash
+
         logger.info("Patching the statefulset")
 
         pod_spec_patch = {
@@ -292,7 +702,6 @@ class OPAAuditCharm(CharmBase):
                     ],
                 },
             ],
-            "priorityClassName": "system-cluster-critical",
             "volumes": [
                 {
                     "name": "cert",
@@ -302,12 +711,18 @@ class OPAAuditCharm(CharmBase):
                     },
                 },
             ],
+            **pod_placement(self.config, self.app.name),
         }
 
         patch = {"spec": {"template": {"spec": pod_spec_patch}}}
+        digest = content_hash(patch)
+        if digest == self._stored.statefulset_patch:
+            logger.info("Statefulset patch unchanged")
+            return
         self.client.patch(
             StatefulSet, name=self.app.name, namespace=self.model.name, obj=patch
         )
+        self._stored.statefulset_patch = digest
 
 
 if __name__ == "__main__":
@@ -0,0 +1,167 @@
+"""Content-addressed store of the releases of the upstream manifests.
+
+The upstream YAML manifests of each release are the source, and the store is
+generated from them. Every object of every release is stored once, compressed,
+under the digest of its content, so that the objects a release shares with
+others take no extra space. An index lists the digests of each release's
+objects in order:
+
+    <base_path>
+    ├── version                  - the default release
+    ├── manifests
+    │   └── v3.10.0
+    │       └── gatekeeper.yaml  - the upstream manifests of a release
+    └── store
+        ├── index.json           - {"v3.10.0": ["<digest>", ...], ...}
+        └── objects
+            └── <digest>         - the object as gzipped JSON
+
+Listing the releases only reads the index, and building a release only decodes
+that release's objects. After adding, changing or removing the manifests of a
+release, regenerate the store with
+
+    python src/manifest_store.py upstream/controller-manager
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import re
+from functools import cached_property
+from pathlib import Path
+from typing import Dict, Iterator, List, Mapping
+
+log = logging.getLogger(__name__)
+
+INDEX = "index.json"
+OBJECTS = "objects"
+FILE_TYPES = ("yaml", "yml")
+
+
+def version_key(release: str) -> List:
+    """Sort key of a release, comparing its numbers numerically."""
+    return [
+        int(part) if part.isdigit() else part for part in re.split(r"(\d+)", release)
+    ]
+
+
+def digest(obj: Mapping) -> str:
+    """Digest of an object's content, independent of key order."""
+    content = json.dumps(obj, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def flatten(documents, source="") -> List[Mapping]:
+    """Kubernetes objects of YAML documents, with the items of *List kinds."""
+    objects = []
+    for obj in documents:
+        if not isinstance(obj, Mapping) or not obj.get("kind"):
+            log.warning(f"Ignoring non-kubernetes document {obj!r} in {source}")
+        elif obj["kind"].endswith("List"):
+            objects += flatten(obj.get("items") or [], source)
+        elif obj.get("apiVersion"):
+            objects.append(obj)
+        else:
+            log.warning(f"Ignoring non-kubernetes document {obj!r} in {source}")
+    return objects
+
+
+class ManifestStore:
+    """Releases of manifests, as ordered lists of shared objects."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    @cached_property
+    def index(self) -> Dict[str, List[str]]:
+        index = self.path / INDEX
+        if not index.exists():
+            return {}
+        return json.loads(index.read_text())
+
+    @property
+    def releases(self) -> List[str]:
+        return list(self.index)
+
+    def objects(self, release: str) -> Iterator[Dict]:
+        """Decode the objects of a release, in their order in its manifests."""
+        if release not in self.index:
+            log.error(f"Release {release} isn't in the manifest store")
+            return
+        for key in self.index[release]:
+            yield json.loads(gzip.decompress((self.path / OBJECTS / key).read_bytes()))
+
+    def add(self, release: str, objects: List[Mapping]):
+        """Store a release's objects, replacing any release of the same name."""
+        (self.path / OBJECTS).mkdir(parents=True, exist_ok=True)
+        keys = []
+        for obj in objects:
+            key = digest(obj)
+            stored = self.path / OBJECTS / key
+            if not stored.exists():
+                # no mtime in the header, so an object always compresses the same
+                content = json.dumps(obj, separators=(",", ":")).encode()
+                stored.write_bytes(gzip.compress(content, mtime=0))
+            keys.append(key)
+        self._write_index({**self.index, release: keys})
+
+    def remove(self, release: str):
+        """Remove a release, and the objects no other release has."""
+        index = dict(self.index)
+        dropped = set(index.pop(release))
+        self._write_index(index)
+        for key in dropped.difference(*index.values()):
+            (self.path / OBJECTS / key).unlink()
+
+    def _write_index(self, index):
+        content = json.dumps(dict(sorted(index.items())), indent=1)
+        (self.path / INDEX).write_text(content + "\n")
+        self.__dict__["index"] = index
+
+
+def load_manifests(path: Path) -> List[Mapping]:
+    """The objects of a release's YAML manifests, in file order."""
+    import yaml
+
+    files = sorted(f for ext in FILE_TYPES for f in path.glob(f"*.{ext}"))
+    return [
+        obj
+        for file in files
+        for obj in flatten(yaml.safe_load_all(file.read_text()), file)
+    ]
+
+
+def generate(manifests: Path, store: Path) -> "ManifestStore":
+    """Generate the store from the YAML manifests of every release.
+
+    @param manifests:  folder of the releases' manifests, one folder per release
+    @param store:      folder of the store, whose content is replaced
+    """
+    generated = ManifestStore(store)
+    releases = sorted(path.name for path in manifests.iterdir() if path.is_dir())
+    for release in releases:
+        generated.add(release, load_manifests(manifests / release))
+    for release in set(generated.releases) - set(releases):
+        generated.remove(release)
+    if (objects := store / OBJECTS).exists():
+        used = {key for keys in generated.index.values() for key in keys}
+        for path in objects.iterdir():
+            if path.name not in used:
+                path.unlink()
+    return generated
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("base_path", type=Path, help="e.g. upstream/controller-manager")
+    args = parser.parse_args()
+
+    store = generate(args.base_path / "manifests", args.base_path / "store")
+    for release, keys in store.index.items():
+        print(f"{release}: {len(keys)} objects")
+
+
+if __name__ == "__main__":
+    main()
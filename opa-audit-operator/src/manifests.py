@@ -1,11 +1,64 @@
+import hashlib
+import json
 import logging
-from typing import Dict
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+from pathlib import Path
+from typing import Dict, FrozenSet, Iterable, KeysView, List, Mapping, Optional, Tuple
 
+from httpx import HTTPError
+from lightkube import ApiError, Client
 from lightkube.codecs import from_dict
-from ops.manifests import ManifestLabel, Manifests, Patch, SubtractEq
+from lightkube.generic_resource import (
+    create_global_resource,
+    create_namespaced_resource,
+    create_resources_from_crd,
+)
+from lightkube.resources.apiextensions_v1 import CustomResourceDefinition
+from ops.manifests import (
+    Addition,
+    ManifestClientError,
+    ManifestLabel,
+    Manifests,
+    Patch,
+    SubtractEq,
+)
+from ops.manifests.literals import APP_LABEL, MANIFEST_LABEL
+from ops.manifests.manipulations import HashableResource, Subtraction
+
+from external_data import parse_providers, provider_resources
+from manifest_store import ManifestStore, version_key
+from shared_resources import SHARED_KINDS
 
 log = logging.getLogger(__file__)
 
+# Concurrent API requests when re-applying or deleting resources
+APPLY_WORKERS = 4
+# Seconds to wait for applied CRDs to serve their custom resources
+CRD_ESTABLISHED_TIMEOUT = 60
+# Metadata the API server sets on the objects it stores
+SERVER_METADATA = (
+    "creationTimestamp",
+    "generation",
+    "managedFields",
+    "resourceVersion",
+    "uid",
+)
+
+ConstraintTemplate = create_global_resource(
+    "templates.gatekeeper.sh", "v1", "ConstraintTemplate", "constrainttemplates"
+)
+CONSTRAINT_TEMPLATE_CRD = "constrainttemplates.templates.gatekeeper.sh"
+# registered ahead of their CRDs, for the resources added to the manifests
+create_namespaced_resource("config.gatekeeper.sh", "v1alpha1", "Config", "configs")
+create_global_resource(
+    "externaldata.gatekeeper.sh", "v1alpha1", "Provider", "providers"
+)
+# Gatekeeper processes a Config match entry may exclude namespaces from
+PROCESSES = frozenset({"audit", "webhook", "mutation-webhook", "sync", "*"})
+WEBHOOK_KINDS = ("ValidatingWebhookConfiguration", "MutatingWebhookConfiguration")
+
 audit_controller = from_dict(
     dict(
         apiVersion="apps/v1",
@@ -67,6 +120,141 @@ pod_disruption_budget = from_dict(
 )
 
 
+def content_hash(obj) -> str:
+    """Stable hash of a resource's content, independent of key order."""
+    content = json.dumps(obj, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def resource_id(rsc: HashableResource) -> str:
+    """Identify a resource across releases, e.g. "v1 Service gatekeeper-system name"."""
+    return " ".join((rsc.resource.apiVersion, rsc.kind, rsc.namespace or "", rsc.name))
+
+
+def from_resource_id(key: str) -> HashableResource:
+    api_version, kind, namespace, name = key.split(" ")
+    metadata = dict(name=name, namespace=namespace or None)
+    return HashableResource(
+        from_dict(dict(apiVersion=api_version, kind=kind, metadata=metadata))
+    )
+
+
+def applied_fields(obj):
+    """The fields of a manifest object which applying it sets.
+
+    The status, such as the placeholder the upstream CRDs have, is a
+    subresource apply never writes, and the server owns some of the metadata.
+    """
+    obj = {key: value for key, value in obj.items() if key != "status"}
+    if metadata := obj.get("metadata"):
+        obj["metadata"] = {
+            key: value for key, value in metadata.items() if key not in SERVER_METADATA
+        }
+    return obj
+
+
+def managed_fields(live, desired):
+    """Project a live object onto the fields the charm applies to it.
+
+    Fields the charm doesn't set, e.g. server-side defaults, status and the
+    rest of the metadata, are left out, so that only a change to a field the
+    charm manages shows up as drift.
+    """
+    if isinstance(desired, dict):
+        live = live if isinstance(live, dict) else {}
+        return {
+            key: managed_fields(live.get(key), value) for key, value in desired.items()
+        }
+    if (
+        isinstance(desired, list)
+        and isinstance(live, list)
+        and len(live) == len(desired)
+    ):
+        return [managed_fields(item, value) for item, value in zip(live, desired)]
+    return live
+
+
+def differences(live, desired, path="") -> List[str]:
+    """Paths of the fields whose live value differs from the desired one."""
+    if isinstance(desired, dict) and isinstance(live, dict):
+        return [
+            diff
+            for key, value in desired.items()
+            for diff in differences(live.get(key), value, f"{path}.{key}")
+        ]
+    if (
+        isinstance(desired, list)
+        and isinstance(live, list)
+        and len(live) == len(desired)
+    ):
+        return [
+            diff
+            for i, (item, value) in enumerate(zip(live, desired))
+            for diff in differences(item, value, f"{path}[{i}]")
+        ]
+    return [] if live == desired else [path.lstrip(".")]
+
+
+def match_exclusions(*values: str) -> List[Dict]:
+    """Parse match-exclusions options into the spec.match entries of a Config.
+
+    Each space separated entry is a namespace, which may start or end with a *
+    wildcard, optionally followed by a colon and the comma separated processes
+    to exclude it from, e.g. `ci-*:audit,webhook`. Without processes the
+    namespace is excluded from all of them. Namespaces excluded from the same
+    processes are grouped into one entry.
+    """
+    excluded: Dict[str, set] = {}
+    for entry in " ".join(values).split():
+        namespace, _, processes = entry.partition(":")
+        processes = set(filter(None, processes.split(","))) or {"*"}
+        if not namespace or not processes <= PROCESSES:
+            log.error(f"Ignoring match exclusion {entry}: not namespace[:processes]")
+            continue
+        excluded.setdefault(namespace, set()).update(processes)
+
+    by_processes: Dict[tuple, List[str]] = {}
+    for namespace, processes in sorted(excluded.items()):
+        key = ("*",) if "*" in processes else tuple(sorted(processes))
+        by_processes.setdefault(key, []).append(namespace)
+    return [
+        {"excludedNamespaces": namespaces, "processes": list(processes)}
+        for processes, namespaces in sorted(by_processes.items())
+    ]
+
+
+class PatchIndex:
+    """The patches to run on each object, by the object's kind and name.
+
+    A patch may set `kinds` and `names` to the objects it applies to, leaving
+    either empty for any kind or name, so that each object only runs the
+    patches applying to it. Patches setting neither, such as ManifestLabel,
+    run on every object. An object's patches keep the order of the
+    manipulations.
+    """
+
+    def __init__(self, patches: Iterable[Patch]):
+        self._by_key: Dict[Tuple, List[Tuple[int, Patch]]] = {}
+        for order, patch in enumerate(patches):
+            for kind in getattr(patch, "kinds", None) or (None,):
+                for name in getattr(patch, "names", None) or (None,):
+                    self._by_key.setdefault((kind, name), []).append((order, patch))
+        self._cache: Dict[Tuple[str, str], List[Patch]] = {}
+
+    def __getitem__(self, key: Tuple[str, str]) -> List[Patch]:
+        if (patches := self._cache.get(key)) is None:
+            kind, name = key
+            found = [
+                *self._by_key.get((kind, name), ()),
+                *self._by_key.get((kind, None), ()),
+                *self._by_key.get((None, name), ()),
+                *self._by_key.get((None, None), ()),
+            ]
+            found.sort(key=lambda item: item[0])
+            patches = self._cache[key] = [patch for _, patch in found]
+        return patches
+
+
 class ModelNamespace(Patch):
     """Update the namespace of any namespaced resources to the model name."""
 
@@ -81,13 +269,56 @@ class ModelNamespace(Patch):
 class RoleBinding(Patch):
     """Update the namespace of any RoleBinding or ClusteRoleBinding subjects to the model name."""
 
+    kinds = ("RoleBinding", "ClusterRoleBinding")
+
     def __call__(self, obj):
-        if obj.kind == "RoleBinding" or obj.kind == "ClusterRoleBinding":
-            for subject in obj.subjects:
-                log.info(
-                    f"Patching subject namespace for {obj.kind} {obj.metadata.name}"
-                )
-                subject.namespace = self.manifests.model.name
+        for subject in obj.subjects:
+            log.info(f"Patching subject namespace for {obj.kind} {obj.metadata.name}")
+            subject.namespace = self.manifests.model.name
+
+
+class GatekeeperConfig(Addition):
+    """Gatekeeper's Config, excluding namespaces from some of its processes.
+
+    The exclusions of the related application, which leaves the Config to this
+    one while related, are merged with this application's.
+    """
+
+    def __call__(self):
+        match = match_exclusions(
+            self.manifests.config.get("match-exclusions", ""),
+            *self.manifests.shared_resources.contributed("match-exclusions"),
+        )
+        config = from_dict(
+            dict(
+                apiVersion="config.gatekeeper.sh/v1alpha1",
+                kind="Config",
+                metadata=dict(name="config", namespace=self.manifests.model.name),
+                # without exclusions, leave any match set by hand alone
+                spec=dict(match=match) if match else {},
+            )
+        )
+        # a generic resource would be iterated as a mapping
+        return [config]
+
+
+class ExternalDataProviders(Addition):
+    """The external data providers declared in the config, and by the related app."""
+
+    def __call__(self):
+        config = self.manifests.config
+        if not config.get("external-data"):
+            return None
+        providers = parse_providers(
+            config.get("external-data-providers", ""),
+            *self.manifests.shared_resources.contributed("external-data-providers"),
+        )
+        return [
+            from_dict(provider)
+            for provider in provider_resources(
+                providers, config["external-data-timeout"]
+            )
+        ]
 
 
 class ControllerManagerManifests(Manifests):
@@ -101,6 +332,8 @@ class ControllerManagerManifests(Manifests):
             SubtractEq(self, validating_webhook),
             SubtractEq(self, mutating_webhook),
             SubtractEq(self, pod_disruption_budget),
+            GatekeeperConfig(self),
+            ExternalDataProviders(self),
             ManifestLabel(self),
             ModelNamespace(self),
             RoleBinding(self),
@@ -112,6 +345,275 @@ class ControllerManagerManifests(Manifests):
             manipulations,
         )
         self.charm_config = charm_config
+        self.instrument_client = charm.instrument_client
+        self.shared_resources = charm.shared_resources
+
+    @cached_property
+    def client(self) -> Client:
+        """Lightkube client, rate limited and counted like the charm's own."""
+        return self.instrument_client(super().client)
+
+    @cached_property
+    def patches(self) -> PatchIndex:
+        return PatchIndex(m for m in self.manipulations if isinstance(m, Patch))
+
+    @cached_property
+    def _subtracted(self) -> FrozenSet[HashableResource]:
+        return frozenset(
+            HashableResource(m.to_compare)
+            for m in self.manipulations
+            if isinstance(m, SubtractEq)
+        )
+
+    @cached_property
+    def manifest_path(self) -> Path:
+        """The store generated from the upstream manifests, see manifest_store."""
+        return self.base_path / "store"
+
+    @cached_property
+    def store(self) -> ManifestStore:
+        return ManifestStore(self.manifest_path)
+
+    @cached_property
+    def releases(self) -> List[str]:
+        """The releases in the store, highest first, read from its index alone."""
+        return sorted(self.store.releases, key=version_key, reverse=True)
+
+    def _resources_from_store(self, release: str) -> List:
+        resources = []
+        for item in self.store.objects(release):
+            rsc = from_dict(item)
+            if rsc.kind == "CustomResourceDefinition":
+                create_resources_from_crd(rsc)
+            resources.append(rsc)
+        return resources
+
+    def manifest_resources(self) -> KeysView[HashableResource]:
+        """Every resource of the release, in the order Manifests.resources has them.
+
+        The release's objects are decoded from the manifest store. Objects
+        removed by a SubtractEq are looked up by kind, namespace and name
+        rather than compared with each of them, and each object only runs the
+        patches the index has for it.
+        """
+        additions = [
+            obj
+            for m in self.manipulations
+            if isinstance(m, Addition)
+            for obj in m
+            if obj
+        ]
+        statics = [
+            obj
+            for obj in self._resources_from_store(self.current_release)
+            if HashableResource(obj) not in self._subtracted
+        ]
+        for m in self.manipulations:
+            if isinstance(m, Subtraction) and not isinstance(m, SubtractEq):
+                statics = [obj for obj in statics if not m(obj)]
+
+        resources = additions + statics
+        for obj in resources:
+            for patch in self.patches[obj.kind, obj.metadata.name]:
+                patch(obj)
+        return dict.fromkeys(HashableResource(obj) for obj in resources).keys()
+
+    @property
+    def resources(self) -> KeysView[HashableResource]:
+        """The resources this charm installs, without those owned by a related charm."""
+        resources = self.manifest_resources()
+        if not self.shared_resources.owned_elsewhere:
+            return resources
+        return dict.fromkeys(
+            rsc for rsc in resources if rsc.kind not in SHARED_KINDS
+        ).keys()
+
+    def missing_shared_resources(self) -> List[HashableResource]:
+        """Shared resources which their owner hasn't installed (yet)."""
+        if not self.shared_resources.owned_elsewhere:
+            return []
+        missing = []
+        for rsc in self.manifest_resources():
+            if rsc.kind not in SHARED_KINDS:
+                continue
+            try:
+                self.client.get(type(rsc.resource), rsc.name, namespace=rsc.namespace)
+            except ApiError as e:
+                if e.status.code != 404:
+                    raise
+                missing.append(rsc)
+        return missing
+
+    def apply_manifests(
+        self, applied: Optional[Mapping[str, str]] = None
+    ) -> Dict[str, str]:
+        """Apply the resources which changed since they were last applied.
+
+        Resources whose content hash is unchanged are skipped, and resources
+        no longer in the manifests are deleted. Without the hashes of the last
+        applied resources, every resource is applied.
+
+        @param applied:  content hashes of the resources last applied, by resource_id
+
+        Returns:
+            The content hashes of the resources now applied.
+        """
+        applied = applied or {}
+        current = {
+            resource_id(rsc): (rsc, content_hash(rsc.resource.to_dict()))
+            for rsc in self.resources
+        }
+        changed = [
+            rsc for key, (rsc, digest) in current.items() if applied.get(key) != digest
+        ]
+        removed = [
+            from_resource_id(key)
+            for key in applied
+            if key not in current
+            # left to the charm now owning them, rather than removed
+            and not (
+                self.shared_resources.owned_elsewhere
+                and key.split(" ")[1] in SHARED_KINDS
+            )
+        ]
+        log.info(
+            f"Applying {self.name} version: {self.current_release}, "
+            f"{len(changed)} of {len(current)} resources changed, {len(removed)} removed"
+        )
+        # custom resources, such as the Config, only once their CRD is Established
+        self.apply_resources_parallel(*changed)
+        self.delete_resources(*removed, ignore_not_found=True)
+        return {key: digest for key, (_, digest) in current.items()}
+
+    def delete_collection(self, res, *, namespace=None, labels=None):
+        """Delete every object of a kind, or only those with some labels.
+
+        lightkube's deletecollection can't select the objects by label, so the
+        labelled objects are listed and deleted one at a time instead.
+        """
+        if not labels:
+            self.client.deletecollection(res, namespace=namespace)
+            return
+        for obj in self.client.list(res, namespace=namespace, labels=labels):
+            try:
+                self.client.delete(
+                    res, obj.metadata.name, namespace=obj.metadata.namespace
+                )
+            except ApiError as e:
+                if e.status.code != 404:  # unless deleted meanwhile
+                    raise
+
+    def delete_manifests(self, ignore_not_found=False, ignore_unauthorized=False):
+        """Delete the manifest's resources by kind, see delete_collection.
+
+        Kinds are deleted concurrently, in three phases: the webhooks, so that
+        the API server stops calling a webhook that is going away, along with
+        the ConstraintTemplates; then everything else; and the CRDs last, once
+        nothing depends on them. Kinds which can't be deleted as a collection
+        are deleted one object at a time.
+        """
+        labels = {APP_LABEL: self.model.app.name, MANIFEST_LABEL: self.name}
+        # resources by (kind, namespace, whether to select by the labels)
+        webhooks, others, crds = {}, {}, {}
+        for rsc in self.resources:
+            collection = type(rsc.resource), rsc.namespace, True
+            if rsc.kind in WEBHOOK_KINDS:
+                phase = webhooks
+            elif rsc.kind == "CustomResourceDefinition":
+                phase = crds
+                if rsc.name == CONSTRAINT_TEMPLATE_CRD:
+                    # they'd go with their CRD anyway, but only after the rest
+                    webhooks[ConstraintTemplate, None, False] = []
+            else:
+                phase = others
+            phase.setdefault(collection, []).append(rsc)
+
+        def delete(collection, resources):
+            res, namespace, labelled = collection
+            log.info(
+                f"Deleting the {res.__name__} collection in {namespace or 'cluster'}"
+            )
+            try:
+                self.delete_collection(
+                    res, namespace=namespace, labels=labels if labelled else None
+                )
+            except ValueError:
+                # lightkube knows the kind doesn't support deletecollection
+                self.delete_resources(*resources, **ignore)
+            except (ApiError, HTTPError) as ex:
+                code = getattr(getattr(ex, "status", None), "code", None)
+                if code == 405:
+                    self.delete_resources(*resources, **ignore)
+                elif (ignore_not_found and code == 404) or (
+                    ignore_unauthorized and code in (401, 403)
+                ):
+                    log.warning(f"Ignored failed delete of {res.__name__}: {ex}")
+                else:
+                    msg = f"Failed to delete {res.__name__}"
+                    log.exception(msg)
+                    raise ManifestClientError(msg, ex) from ex
+
+        ignore = dict(
+            ignore_not_found=ignore_not_found, ignore_unauthorized=ignore_unauthorized
+        )
+        self.client  # load the in-cluster resources before the workers start
+        with ThreadPoolExecutor(APPLY_WORKERS) as pool:
+            for phase in (webhooks, others, crds):
+                list(pool.map(delete, phase.keys(), phase.values()))
+
+    def drifted_resources(
+        self, installed: FrozenSet[HashableResource]
+    ) -> Dict[HashableResource, List[str]]:
+        """Installed resources whose managed fields differ from the manifests.
+
+        @param installed:  the live resources, as from installed_resources()
+
+        Returns:
+            The paths of the drifted fields of each drifted resource.
+        """
+        live = {rsc: rsc for rsc in installed}
+        drifted = {}
+        for rsc in self.resources:
+            if rsc not in live:
+                continue
+            desired = applied_fields(rsc.resource.to_dict())
+            current = managed_fields(live[rsc].resource.to_dict(), desired)
+            if content_hash(current) != content_hash(desired):
+                drifted[rsc] = differences(current, desired)
+        return drifted
+
+    def apply_resources_parallel(self, *resources: HashableResource):
+        """Apply resources concurrently, the CRDs first.
+
+        Custom resources, such as the Config, can only be applied once their
+        CRD is Established, so the CRDs are applied and waited for before the
+        rest, like the phases of delete_manifests.
+        """
+        crds = [rsc for rsc in resources if rsc.kind == "CustomResourceDefinition"]
+        others = [rsc for rsc in resources if rsc.kind != "CustomResourceDefinition"]
+        self.client  # load the in-cluster resources once, before the workers start
+        with ThreadPoolExecutor(APPLY_WORKERS) as pool:
+            # consume the results to raise the first failure
+            list(pool.map(self.apply_resources, crds))
+            list(pool.map(self._wait_established, crds))
+            list(pool.map(self.apply_resources, others))
+
+    def _wait_established(self, crd: HashableResource):
+        """Wait for an applied CRD to be Established."""
+        deadline = time.monotonic() + CRD_ESTABLISHED_TIMEOUT
+        while True:
+            try:
+                live = self.client.get(CustomResourceDefinition, crd.name)
+            except (ApiError, HTTPError) as ex:
+                msg = f"Failed getting {crd}"
+                log.exception(msg)
+                raise ManifestClientError(msg, ex) from ex
+            conditions = (live.status and live.status.conditions) or []
+            if any(c.type == "Established" and c.status == "True" for c in conditions):
+                return
+            if time.monotonic() >= deadline:
+                raise ManifestClientError(f"{crd} not Established")
+            time.sleep(1)
 
     @property
     def config(self) -> Dict:
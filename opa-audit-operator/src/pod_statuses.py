@@ -0,0 +1,102 @@
+"""Garbage collection of gatekeeper's per-pod status objects.
+
+Every gatekeeper pod reports its view of each constraint and ConstraintTemplate
+in status objects labelled with the pod's name. Gatekeeper doesn't remove the
+objects of pods which are gone, e.g. after the application is scaled down, so
+the leader deletes them. Only the objects of pods other than the live ones are
+listed, a page at a time.
+"""
+
+import logging
+import re
+from typing import Dict, List
+
+from lightkube.generic_resource import create_namespaced_resource
+from lightkube.operators import not_in
+from lightkube.resources.core_v1 import Pod
+
+log = logging.getLogger(__name__)
+
+ConstraintPodStatus = create_namespaced_resource(
+    "status.gatekeeper.sh",
+    "v1beta1",
+    "ConstraintPodStatus",
+    "constraintpodstatuses",
+)
+ConstraintTemplatePodStatus = create_namespaced_resource(
+    "status.gatekeeper.sh",
+    "v1beta1",
+    "ConstraintTemplatePodStatus",
+    "constrainttemplatepodstatuses",
+)
+# Label gatekeeper sets on the status objects it creates for each pod
+POD_LABEL = "internal.gatekeeper.sh/pod"
+# Status objects requested per page
+LIST_CHUNK_SIZE = 500
+
+
+def live_pods(client, namespace, app) -> List[str]:
+    """The sorted names of the application's pods."""
+    pods = client.list(Pod, namespace=namespace, labels={"app.kubernetes.io/name": app})
+    return sorted(pod.metadata.name for pod in pods)
+
+
+def stale_pod_statuses(
+    client, namespace, app, live: List[str]
+) -> Dict[type, Dict[str, List[str]]]:
+    """Find the status objects of the application's pods which no longer exist.
+
+    Only pods named after the application are considered, since the pods of
+    another gatekeeper application may report to the same namespace.
+
+    @param live:  the names of the application's pods, see live_pods
+
+    Returns:
+        The names of the stale objects of each kind, by pod name.
+    """
+    pod_name = re.compile(rf"{re.escape(app)}-\d+")
+    labels = {POD_LABEL: not_in(live)} if live else None
+
+    stale = {}
+    for kind in (ConstraintPodStatus, ConstraintTemplatePodStatus):
+        names: Dict[str, List[str]] = {}
+        pod_statuses = client.list(
+            kind, namespace=namespace, labels=labels, chunk_size=LIST_CHUNK_SIZE
+        )
+        for pod_status in pod_statuses:
+            pod = (pod_status.metadata.labels or {}).get(POD_LABEL, "")
+            if pod_name.fullmatch(pod) and pod not in live:
+                names.setdefault(pod, []).append(pod_status.metadata.name)
+        stale[kind] = names
+    return stale
+
+
+def delete_stale_pod_statuses(client, namespace, app, live: List[str]) -> int:
+    """Delete the stale status objects.
+
+    @param client:     lightkube client
+    @param namespace:  namespace of the gatekeeper pods
+    @param app:        name of the application running the gatekeeper pods
+    @param live:       the names of the application's pods, see live_pods
+
+    Returns:
+        The number of objects deleted.
+    """
+    from lightkube import ApiError
+
+    deleted = 0
+    for kind, names in stale_pod_statuses(client, namespace, app, live).items():
+        if not names:
+            continue
+        log.info(
+            f"Deleting {sum(map(len, names.values()))} {kind.__name__} objects "
+            f"of pods {', '.join(sorted(names))}"
+        )
+        for name in (name for pod in sorted(names) for name in names[pod]):
+            try:
+                client.delete(kind, name, namespace=namespace)
+            except ApiError as e:
+                if e.status.code != 404:  # unless deleted meanwhile
+                    raise
+            deleted += 1
+    return deleted
@@ -0,0 +1,55 @@
+"""Bounded retries with exponential backoff for Kubernetes API calls."""
+
+import logging
+import random
+import time
+
+log = logging.getLogger(__name__)
+
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 30.0
+
+
+def retry(operation, budget, exceptions=None):
+    """Call operation until it succeeds or the time budget is spent.
+
+    Waits between attempts grow exponentially with full jitter, capped at
+    BACKOFF_CAP seconds, and never extend past the budget.
+
+    @param operation:   callable taking no arguments
+    @param budget:      seconds available for all attempts and waits
+    @param exceptions:  exception types worth retrying, by default ManifestClientError
+
+    Returns:
+        True if operation succeeded, False if the budget ran out.
+    """
+    if exceptions is None:
+        from ops.manifests import ManifestClientError
+
+        exceptions = (ManifestClientError,)
+    deadline = time.monotonic() + budget
+    attempt = 0
+    waited = 0.0
+    while True:
+        attempt += 1
+        try:
+            operation()
+        except exceptions as e:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                log.warning(
+                    f"Attempt {attempt} failed ({e}), giving up after "
+                    f"{attempt} attempts and {waited:.1f}s of waiting"
+                )
+                return False
+            backoff = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+            backoff = min(backoff, remaining)
+            log.info(f"Attempt {attempt} failed ({e}), retrying in {backoff:.1f}s")
+            time.sleep(backoff)
+            waited += backoff
+        else:
+            if attempt > 1:
+                log.info(
+                    f"Succeeded after {attempt} attempts and {waited:.1f}s of waiting"
+                )
+            return True
@@ -1,4 +1,7 @@
+import json
+import threading
 import unittest.mock as mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import pytest
 from ops.pebble import ServiceStatus
@@ -10,13 +13,15 @@ from charm import OPAAuditCharm
 @pytest.fixture(autouse=True)
 def lk_client():
     with mock.patch("ops.manifests.manifest.Client", autospec=True) as mock_lightkube:
-        with mock.patch("charm.Client", mock_lightkube):
+        with mock.patch("lightkube.Client", mock_lightkube):
             yield mock_lightkube.return_value
 
 
 @pytest.fixture(autouse=True)
 def mocked_service_patch(mocker):
-    mocked_service_patch = mocker.patch("charm.KubernetesServicePatch")
+    mocked_service_patch = mocker.patch(
+        "charms.observability_libs.v1.kubernetes_service_patch.KubernetesServicePatch"
+    )
     yield mocked_service_patch
 
 
@@ -35,6 +40,13 @@ def mock_installed_resources(monkeypatch):
     return mocked_resources
 
 
+@pytest.fixture(autouse=True)
+def start_watcher(monkeypatch):
+    start = mock.MagicMock()
+    monkeypatch.setattr("drift_watcher.start_watcher", start)
+    return start
+
+
 @pytest.fixture
 def harness(mocker):
     harness = Harness(OPAAuditCharm)
@@ -64,3 +76,42 @@ def active_service(mocker):
 def active_container(mocker, container, active_service):
     container.get_service = mocker.MagicMock(return_value=active_service)
     return container
+
+
+@pytest.fixture()
+def external_data_provider():
+    """A local external data provider, answering each key with its upper case."""
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):  # noqa: N802
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            requests.append(body)
+            keys = body["request"]["keys"]
+            answer = json.dumps(
+                {
+                    "apiVersion": "externaldata.gatekeeper.sh/v1beta1",
+                    "kind": "ProviderResponse",
+                    "response": {
+                        "idempotent": True,
+                        "items": [{"key": key, "value": key.upper()} for key in keys],
+                    },
+                }
+            ).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(answer)))
+            self.end_headers()
+            self.wfile.write(answer)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.requests = requests
+    server.url = f"http://127.0.0.1:{server.server_port}/validate"
+    yield server
+    server.shutdown()
+    server.server_close()
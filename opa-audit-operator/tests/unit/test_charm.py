@@ -1,11 +1,33 @@
+import json
 import logging
+import os
+import subprocess
+import sys
+from fnmatch import fnmatch
+from pathlib import Path
 from unittest.mock import MagicMock
 
+import httpx
 import ops.testing
+import pytest
+import yaml
+from lightkube import ApiError
+from lightkube.codecs import from_dict
+from lightkube.core.selector import build_selector
 from lightkube.resources.apps_v1 import StatefulSet
-from ops.model import BlockedStatus
+from ops.manifests import ManifestClientError
+from ops.manifests.manipulations import HashableResource
+from ops.model import ActiveStatus, BlockedStatus, WaitingStatus
+
+import drift_watcher
+import manifests
+from autotune import AuditObservation
+from manifests import ControllerManagerManifests
+from ratelimit import TokenBucket
 
 ops.testing.SIMULATE_CAN_CONNECT = True
+# before conftest replaces it
+MANIFEST_RESOURCES = ControllerManagerManifests.resources
 
 
 def test_on_install(harness, lk_client, monkeypatch):
@@ -24,9 +46,64 @@ def test_on_install(harness, lk_client, monkeypatch):
     assert all(i[0][0].kind not in excluded for i in lk_client.apply.call_args_list)
 
 
-def test_on_config_changed(harness, active_container):
+def test_upgrade_applies_changed_resources(harness, monkeypatch):
+    def config_map(data):
+        return from_dict(
+            {
+                "apiVersion": "v1",
+                "kind": "ConfigMap",
+                "metadata": {"name": "gatekeeper-config", "namespace": "m"},
+                "data": data,
+            }
+        )
+
+    role = from_dict(
+        {
+            "apiVersion": "rbac.authorization.k8s.io/v1",
+            "kind": "ClusterRole",
+            "metadata": {"name": "gatekeeper-manager-role"},
+        }
+    )
+    resources = [HashableResource(role), HashableResource(config_map({"a": "1"}))]
+    monkeypatch.setattr(
+        "manifests.ControllerManagerManifests.resources",
+        property(lambda _: dict.fromkeys(resources).keys()),
+    )
+    apply_resources, delete_resources = MagicMock(), MagicMock()
+    monkeypatch.setattr(
+        "manifests.ControllerManagerManifests.apply_resources_parallel",
+        apply_resources,
+    )
+    monkeypatch.setattr(
+        "manifests.ControllerManagerManifests.delete_resources", delete_resources
+    )
+
+    harness.charm.on.install.emit()
+    assert apply_resources.call_args.args == tuple(resources)
+
+    harness.charm.on.upgrade_charm.emit()
+    assert apply_resources.call_args.args == ()
+
+    resources[:] = [HashableResource(config_map({"a": "2"}))]
+    harness.charm.on.upgrade_charm.emit()
+    assert apply_resources.call_args.args == tuple(resources)
+    (removed,) = delete_resources.call_args.args
+    assert str(removed) == "ClusterRole/gatekeeper-manager-role"
+
+    # a new leader doesn't know what the previous leader applied
+    harness.charm.on.leader_elected.emit()
+    harness.charm.on.upgrade_charm.emit()
+    assert apply_resources.call_args.args == tuple(resources)
+
+
+def test_on_config_changed_unchanged_service(harness, active_container):
     assert harness.charm._on_config_changed({}) is None
-    active_container.restart.assert_called_once()
+    active_container.restart.assert_not_called()
+
+
+def test_on_config_changed_runtime_only(harness, active_container):
+    harness.update_config({"metrics-scrape-interval": "30s"})
+    active_container.restart.assert_not_called()
 
 
 def test_on_remove(harness, monkeypatch):
@@ -36,6 +113,366 @@ def test_on_remove(harness, monkeypatch):
     mock.assert_called_once()
 
 
+def test_on_remove_deletes_collections(harness, monkeypatch):
+    def resource(api_version, kind, name, namespace=None, **fields):
+        metadata = {"name": name, "namespace": namespace}
+        obj = {"apiVersion": api_version, "kind": kind, "metadata": metadata}
+        return HashableResource(from_dict({**obj, **fields}))
+
+    crd_spec = {
+        "group": "templates.gatekeeper.sh",
+        "names": {"kind": "ConstraintTemplate", "plural": "constrainttemplates"},
+        "scope": "Cluster",
+        "versions": [{"name": "v1", "served": True, "storage": True}],
+    }
+    resources = [
+        resource(
+            "apiextensions.k8s.io/v1",
+            "CustomResourceDefinition",
+            "constrainttemplates.templates.gatekeeper.sh",
+            spec=crd_spec,
+        ),
+        resource(
+            "apiextensions.k8s.io/v1",
+            "CustomResourceDefinition",
+            "configs.config.gatekeeper.sh",
+            spec=crd_spec,
+        ),
+        resource("v1", "Service", "gatekeeper-webhook-service", namespace="m"),
+        resource(
+            "admissionregistration.k8s.io/v1",
+            "ValidatingWebhookConfiguration",
+            "gatekeeper-validating-webhook-configuration",
+        ),
+        resource("rbac.authorization.k8s.io/v1", "ClusterRole", "gatekeeper-role"),
+    ]
+    monkeypatch.setattr(
+        "manifests.ControllerManagerManifests.resources",
+        property(lambda _: dict.fromkeys(resources).keys()),
+    )
+    delete_collection = MagicMock()
+    monkeypatch.setattr(
+        "manifests.ControllerManagerManifests.delete_collection", delete_collection
+    )
+
+    harness.charm.on.remove.emit()
+
+    deleted = [
+        (call.args[0].__name__, call.kwargs["namespace"], bool(call.kwargs["labels"]))
+        for call in delete_collection.call_args_list
+    ]
+    # webhooks and templates first, CRDs last, kinds within a phase in parallel
+    assert set(deleted[:2]) == {
+        ("ValidatingWebhookConfiguration", None, True),
+        ("ConstraintTemplate", None, False),
+    }
+    assert set(deleted[2:4]) == {("Service", "m", True), ("ClusterRole", None, True)}
+    assert deleted[4:] == [("CustomResourceDefinition", None, True)]
+
+
+def test_delete_collection(harness, lk_client):
+    def named(name):
+        obj = MagicMock()
+        obj.metadata.name, obj.metadata.namespace = name, "m"
+        return obj
+
+    response = httpx.Response(
+        404,
+        json={"kind": "Status", "code": 404, "message": "not found"},
+        request=httpx.Request("DELETE", "https://apiserver"),
+    )
+    listed = [named("a"), named("b")]
+    lk_client.list.side_effect = lambda res, **_: listed if res is StatefulSet else []
+    lk_client.delete.side_effect = [
+        ApiError(request=response.request, response=response),
+        None,
+    ]
+    labels = {"juju.io/application": harness.charm.app.name}
+
+    manifests = harness.charm.manifests
+    manifests.delete_collection(StatefulSet, namespace="m", labels=labels)
+    lk_client.list.assert_called_with(StatefulSet, namespace="m", labels=labels)
+    assert [call.args[1] for call in lk_client.delete.call_args_list] == ["a", "b"]
+    lk_client.deletecollection.assert_not_called()
+
+    manifests.delete_collection(StatefulSet, namespace="m")
+    lk_client.deletecollection.assert_called_once_with(StatefulSet, namespace="m")
+
+
+def test_stale_pod_statuses_deleted(harness, active_container, lk_client, monkeypatch):
+    def named(name, pod=None):
+        obj = MagicMock()
+        obj.metadata.name = name
+        obj.metadata.labels = {"internal.gatekeeper.sh/pod": pod}
+        return obj
+
+    listed = {
+        "Pod": [named("gatekeeper-audit-0"), named("gatekeeper-audit-2")],
+        "ConstraintPodStatus": [
+            named("a", "gatekeeper-audit-0"),
+            named("b", "gatekeeper-audit-1"),
+            named("c", "gatekeeper-audit-1"),
+            named("d", "gatekeeper-controller-manager-1"),
+        ],
+        "ConstraintTemplatePodStatus": [
+            named("e", "gatekeeper-audit-3"),
+            named("f", "gatekeeper-audit-2"),
+        ],
+    }
+    lk_client.list.side_effect = lambda kind, **_: listed.get(kind.__name__, [])
+    harness.charm.on.update_status.emit()
+
+    deleted = [
+        (call.args[0].__name__, call.args[1], call.kwargs["namespace"])
+        for call in lk_client.delete.call_args_list
+    ]
+    assert deleted == [
+        ("ConstraintPodStatus", "b", "gatekeeper-model"),
+        ("ConstraintPodStatus", "c", "gatekeeper-model"),
+        ("ConstraintTemplatePodStatus", "e", "gatekeeper-model"),
+    ]
+    assert harness.charm.unit.status == ActiveStatus("Deleted 3 stale pod statuses")
+    (status_list,) = [
+        call
+        for call in lk_client.list.call_args_list
+        if call.args[0].__name__ == "ConstraintPodStatus"
+    ]
+    # only the objects of the other pods are listed, a page at a time
+    assert build_selector(status_list.kwargs["labels"]) == (
+        "internal.gatekeeper.sh/pod notin " "(gatekeeper-audit-0,gatekeeper-audit-2)"
+    )
+    assert status_list.kwargs["chunk_size"] == 500
+
+    # without pod churn, the status objects aren't listed again
+    lk_client.list.reset_mock()
+    lk_client.delete.reset_mock()
+    harness.charm.on.update_status.emit()
+    listed = {call.args[0].__name__ for call in lk_client.list.call_args_list}
+    assert "ConstraintPodStatus" not in listed
+    lk_client.delete.assert_not_called()
+
+
+def test_shared_resources_owned_by_manager(
+    harness, active_container, lk_client, monkeypatch
+):
+    def resource(api_version, kind, name, **fields):
+        obj = {"apiVersion": api_version, "kind": kind, "metadata": {"name": name}}
+        return HashableResource(from_dict({**obj, **fields}))
+
+    crd = resource(
+        "apiextensions.k8s.io/v1",
+        "CustomResourceDefinition",
+        "configs.config.gatekeeper.sh",
+        spec={
+            "group": "config.gatekeeper.sh",
+            "names": {"kind": "Config", "plural": "configs"},
+            "scope": "Namespaced",
+            "versions": [{"name": "v1alpha1", "served": True, "storage": True}],
+        },
+    )
+    role = resource("rbac.authorization.k8s.io/v1", "ClusterRole", "gatekeeper-role")
+    account = resource("v1", "ServiceAccount", "gatekeeper-admin")
+    monkeypatch.setattr(
+        "manifests.ControllerManagerManifests.manifest_resources",
+        lambda _: dict.fromkeys([crd, role, account]).keys(),
+    )
+    monkeypatch.setattr(ControllerManagerManifests, "resources", MANIFEST_RESOURCES)
+    monkeypatch.setattr(
+        "manifests.ControllerManagerManifests.installed_resources",
+        lambda _: frozenset({account}),
+    )
+    apply_resources = MagicMock()
+    monkeypatch.setattr(
+        "manifests.ControllerManagerManifests.apply_resources_parallel",
+        apply_resources,
+    )
+    response = httpx.Response(
+        404,
+        json={"kind": "Status", "code": 404, "message": "not found"},
+        request=httpx.Request("GET", "https://apiserver"),
+    )
+    lk_client.get.side_effect = [
+        account.resource,
+        ApiError(request=response.request, response=response),
+        role.resource,
+    ]
+
+    rel_id = harness.add_relation(
+        "gatekeeper-shared",
+        "gatekeeper-controller-manager",
+        app_data={"owner": "gatekeeper-controller-manager"},
+    )
+    manifests = harness.charm.manifests
+    assert list(manifests.resources) == [account]
+    apply_resources.assert_called_once_with(account)
+
+    harness.charm.on.update_status.emit()
+    assert harness.charm.unit.status == WaitingStatus(
+        "Waiting for gatekeeper-controller-manager to install 1 shared resources"
+    )
+
+    # the audit charm takes the shared resources back
+    harness.remove_relation(rel_id)
+    assert apply_resources.call_args.args == (crd, role, account)
+
+
+def test_match_exclusions_contributed(harness, monkeypatch):
+    monkeypatch.setattr(
+        "manifests.ControllerManagerManifests.apply_manifests",
+        MagicMock(return_value={}),
+    )
+    harness.update_config({"match-exclusions": "ci-*:audit"})
+    (config,) = manifests.GatekeeperConfig(harness.charm.manifests)
+    assert config.spec == {
+        "match": [{"excludedNamespaces": ["ci-*"], "processes": ["audit"]}]
+    }
+
+    # while related, the controller manager applies them in its Config
+    rel_id = harness.add_relation(
+        "gatekeeper-shared",
+        "gatekeeper-controller-manager",
+        app_data={"owner": "gatekeeper-controller-manager"},
+    )
+    assert harness.get_relation_data(rel_id, harness.charm.app.name) == {
+        "match-exclusions": "ci-*:audit"
+    }
+    harness.update_config({"match-exclusions": ""})
+    assert harness.get_relation_data(rel_id, harness.charm.app.name) == {}
+
+
+def test_external_data(harness, lk_client, external_data_provider, caplog):
+    providers = f"""
+    tags:
+      url: {external_data_provider.url}
+    signatures:
+      url: https://signatures.example:8090/validate
+      timeout: 10
+    bad:
+      endpoint: https://bad.example
+    """
+
+    def pod(image):
+        container = {"name": "gatekeeper", "image": image}
+        return from_dict(
+            {
+                "apiVersion": "v1",
+                "kind": "Pod",
+                "metadata": {"name": harness.charm.pod_name},
+                "spec": {"containers": [container]},
+            }
+        )
+
+    lk_client.get.return_value = pod("openpolicyagent/gatekeeper:v3.9.0")
+    with caplog.at_level(logging.ERROR):
+        harness.update_config(
+            {
+                "external-data": True,
+                "external-data-providers": providers,
+                "external-data-cache-ttl": "5m",
+            }
+        )
+    command = harness.charm._gatekeeper_layer()["services"]["gatekeeper"]["command"]
+    # the cache TTL flag only exists from gatekeeper 3.11, whatever the manifests
+    assert "--enable-external-data " in command
+    assert "cache-ttl" not in command
+    assert "not supported by gatekeeper v3.9.0" in caplog.text
+
+    # nor is it set when the image's release is unknown
+    lk_client.get.return_value = pod("registry.example/gatekeeper@sha256:0123abcd")
+    command = harness.charm._gatekeeper_layer()["services"]["gatekeeper"]["command"]
+    assert "cache-ttl" not in command
+    assert "the gatekeeper image's tag has no release" in caplog.text
+
+    lk_client.get.return_value = pod("openpolicyagent/gatekeeper:v3.11.0")
+    command = harness.charm._gatekeeper_layer()["services"]["gatekeeper"]["command"]
+    assert (
+        "--enable-external-data --external-data-provider-response-cache-ttl=5m "
+        in command
+    )
+
+    resources = [
+        rsc.to_dict()
+        for rsc in manifests.ExternalDataProviders(harness.charm.manifests)
+    ]
+    assert [(rsc["metadata"]["name"], rsc["spec"]) for rsc in resources] == [
+        (
+            "signatures",
+            {"timeout": 10, "url": "https://signatures.example:8090/validate"},
+        ),
+        ("tags", {"timeout": 3, "url": external_data_provider.url}),
+    ]
+
+    output = harness.run_action(
+        "check-external-data", {"provider": "tags", "keys": "nginx busybox"}
+    )
+    assert output.results["idempotent"] is True
+    assert json.loads(output.results["items"]) == [
+        {"key": "nginx", "value": "NGINX"},
+        {"key": "busybox", "value": "BUSYBOX"},
+    ]
+    assert external_data_provider.requests == [
+        {
+            "apiVersion": "externaldata.gatekeeper.sh/v1beta1",
+            "kind": "ProviderRequest",
+            "request": {"keys": ["nginx", "busybox"]},
+        }
+    ]
+    with pytest.raises(ops.testing.ActionFailed):
+        harness.run_action("check-external-data", {"provider": "bad"})
+
+    harness.update_config({"external-data": False})
+    assert not list(manifests.ExternalDataProviders(harness.charm.manifests))
+
+
+def test_manifest_store(harness, tmp_path, monkeypatch):
+    from manifest_store import ManifestStore, generate
+
+    store = ManifestStore(tmp_path)
+    service = {"apiVersion": "v1", "kind": "Service", "metadata": {"name": "svc"}}
+    old = {"apiVersion": "v1", "kind": "ConfigMap", "metadata": {"name": "cm"}}
+    new = {**old, "data": {"key": "value"}}
+    store.add("v1.0.0", [service, old])
+    store.add("v1.1.0", [new, service])
+    # the service is stored once, for both releases
+    assert len(list((tmp_path / "objects").iterdir())) == 3
+    assert list(ManifestStore(tmp_path).objects("v1.1.0")) == [new, service]
+    store.remove("v1.0.0")
+    assert len(list((tmp_path / "objects").iterdir())) == 2
+    assert ManifestStore(tmp_path).releases == ["v1.1.0"]
+
+    # the store is up to date with the upstream manifests
+    upstream = Path("upstream/controller-manager")
+    generated = generate(upstream / "manifests", tmp_path / "generated")
+    assert generated.index == ManifestStore(upstream / "store").index
+    for path in (upstream / "store" / "objects").iterdir():
+        assert (tmp_path / "generated" / "objects" / path.name).exists()
+    assert len(list((tmp_path / "generated" / "objects").iterdir())) == len(
+        list((upstream / "store" / "objects").iterdir())
+    )
+
+    # only the store is packed, not the manifests it is generated from
+    prime = yaml.safe_load(Path("charmcraft.yaml").read_text())["parts"]["charm"][
+        "prime"
+    ]
+    packed = {
+        str(path.relative_to(upstream))
+        for path in upstream.rglob("*")
+        if path.is_file() and any(fnmatch(str(path), pattern) for pattern in prime)
+    }
+    assert packed == {
+        "version",
+        "store/index.json",
+        *(f"store/objects/{key}" for keys in generated.index.values() for key in keys),
+    }
+
+    # the charm's releases are listed from the index, without decoding them
+    objects = MagicMock()
+    monkeypatch.setattr(manifests.ManifestStore, "objects", objects)
+    output = harness.run_action("list-versions")
+    assert output.results == {"controller-manager-versions": "v3.10.0"}
+    objects.assert_not_called()
+
+
 def test_reconciliation_required(harness, monkeypatch):
     mocked_resources = MagicMock(return_value={"1": None, "2": None, "3": None}.keys())
     mocked_installed_resources = MagicMock(
@@ -54,6 +491,298 @@ def test_reconciliation_required(harness, monkeypatch):
     assert isinstance(harness.charm.unit.status, BlockedStatus)
 
 
+@pytest.fixture
+def drifted_role(monkeypatch):
+    def cluster_role(verbs):
+        return from_dict(
+            {
+                "apiVersion": "rbac.authorization.k8s.io/v1",
+                "kind": "ClusterRole",
+                "metadata": {"name": "gatekeeper-manager-role"},
+                "rules": [{"apiGroups": [""], "resources": ["pods"], "verbs": verbs}],
+            }
+        )
+
+    service_account = from_dict(
+        {
+            "apiVersion": "v1",
+            "kind": "ServiceAccount",
+            "metadata": {"name": "gatekeeper-admin", "namespace": "m"},
+        }
+    )
+    desired = [
+        HashableResource(cluster_role(["get", "list"])),
+        HashableResource(service_account),
+    ]
+    # fields the charm doesn't set are not drift
+    live = cluster_role(["get", "list", "delete"])
+    live.metadata.uid = "1234"
+    monkeypatch.setattr(
+        "manifests.ControllerManagerManifests.resources",
+        property(lambda _: dict.fromkeys(desired).keys()),
+    )
+    monkeypatch.setattr(
+        "manifests.ControllerManagerManifests.installed_resources",
+        lambda _: frozenset({HashableResource(live)}),
+    )
+    apply_resources = MagicMock()
+    monkeypatch.setattr(
+        "manifests.ControllerManagerManifests.apply_resources", apply_resources
+    )
+    return apply_resources
+
+
+def test_reconcile_drifted_resources(harness, drifted_role):
+    event = MagicMock()
+    harness.charm._reconcile_resources(event)
+
+    applied = {str(call.args[0]) for call in drifted_role.call_args_list}
+    assert applied == {
+        "ClusterRole/gatekeeper-manager-role",
+        "ServiceAccount/m/gatekeeper-admin",
+    }
+    event.set_results.assert_called_once_with(
+        {
+            "controller-manager-missing": "ServiceAccount/m/gatekeeper-admin",
+            "controller-manager-drifted": "ClusterRole/gatekeeper-manager-role: "
+            "rules[0].verbs",
+        }
+    )
+
+
+@pytest.mark.parametrize("apply", ["apply_resources_parallel", "apply_manifests"])
+def test_apply_crds_first(harness, lk_client, monkeypatch, apply):
+    def resource(api_version, kind, name, namespace=None, **fields):
+        metadata = {"name": name, "namespace": namespace}
+        obj = {"apiVersion": api_version, "kind": kind, "metadata": metadata}
+        return HashableResource(from_dict({**obj, **fields}))
+
+    crd_spec = {
+        "group": "config.gatekeeper.sh",
+        "names": {"kind": "Config", "plural": "configs"},
+        "scope": "Namespaced",
+        "versions": [{"name": "v1alpha1", "served": True, "storage": True}],
+    }
+    crd = resource(
+        "apiextensions.k8s.io/v1",
+        "CustomResourceDefinition",
+        "configs.config.gatekeeper.sh",
+        spec=crd_spec,
+    )
+    config = resource("config.gatekeeper.sh/v1alpha1", "Config", "config", "m")
+    service = resource("v1", "Service", "gatekeeper-webhook-service", "m")
+    calls = []
+    lk_client.apply.side_effect = lambda obj, **_: calls.append(("apply", obj.kind))
+
+    def get(res, name, **_):
+        calls.append(("get", name))
+        live = MagicMock()
+        established = MagicMock(type="Established", status=str(len(calls) > 2))
+        live.status.conditions = [established]
+        return live
+
+    lk_client.get.side_effect = get
+    monkeypatch.setattr("manifests.time.sleep", MagicMock())
+
+    monkeypatch.setattr(
+        "manifests.ControllerManagerManifests.resources",
+        property(lambda _: dict.fromkeys([config, service, crd]).keys()),
+    )
+    if apply == "apply_manifests":
+        harness.charm.manifests.apply_manifests()
+    else:
+        harness.charm.manifests.apply_resources_parallel(config, service, crd)
+    # the custom resources are only applied once their CRD is Established
+    assert calls[:3] == [
+        ("apply", "CustomResourceDefinition"),
+        ("get", "configs.config.gatekeeper.sh"),
+        ("get", "configs.config.gatekeeper.sh"),
+    ]
+    assert set(calls[3:]) == {("apply", "Config"), ("apply", "Service")}
+
+
+def test_crd_status_is_not_drift(harness, monkeypatch):
+    # the upstream CRDs of the store have a placeholder status, which the API
+    # server fills in, and apply never writes
+    crds = [
+        rsc
+        for rsc in harness.charm.manifests.manifest_resources()
+        if rsc.kind == "CustomResourceDefinition"
+    ]
+    assert crds and all(rsc.resource.status for rsc in crds)
+
+    def live(rsc, flip_scope=False):
+        obj = rsc.resource.to_dict()
+        obj["metadata"].update(uid="1234", resourceVersion="5", generation=1)
+        if flip_scope:
+            scope = obj["spec"]["scope"]
+            obj["spec"]["scope"] = "Cluster" if scope == "Namespaced" else "Namespaced"
+        names = obj["spec"]["names"]
+        obj["status"] = {
+            "acceptedNames": {"kind": names["kind"], "plural": names["plural"]},
+            "conditions": [{"type": "Established", "status": "True"}],
+            "storedVersions": [obj["spec"]["versions"][0]["name"]],
+        }
+        return HashableResource(from_dict(obj))
+
+    monkeypatch.setattr(
+        "manifests.ControllerManagerManifests.resources",
+        property(lambda _: dict.fromkeys(crds).keys()),
+    )
+    installed = frozenset(live(rsc) for rsc in crds)
+    assert harness.charm.manifests.drifted_resources(installed) == {}
+
+    # while a changed spec still is
+    installed = frozenset(live(rsc, flip_scope=True) for rsc in crds)
+    drifted = harness.charm.manifests.drifted_resources(installed)
+    assert drifted == {rsc: ["spec.scope"] for rsc in crds}
+
+
+def test_drifted_resources_status(harness, active_container, drifted_role, monkeypatch):
+    role, _service_account = harness.charm.manifests.resources
+    monkeypatch.setattr(
+        "manifests.ControllerManagerManifests.resources",
+        property(lambda _: dict.fromkeys([role]).keys()),
+    )
+    harness.charm.on.update_status.emit()
+    assert harness.charm.unit.status == BlockedStatus(
+        "Drifted resources, to reconcile run: "
+        f"`juju run {harness.charm.unit.name} reconcile-resources`"
+    )
+
+
+def test_drift_watcher_started_on_leader(harness, start_watcher, drifted_role):
+    # ops emits commit once the hook's events are handled
+    harness.framework.on.commit.emit()
+
+    pid_file, arguments = start_watcher.call_args.args
+    assert pid_file.name == "drift-watcher.pid"
+    assert arguments == [
+        "--unit",
+        "gatekeeper-audit/0",
+        "--charm-dir",
+        str(harness.charm.charm_dir),
+        "--labels",
+        json.dumps(
+            {
+                "juju.io/application": "gatekeeper-audit",
+                "juju.io/manifest": "controller-manager",
+            }
+        ),
+        "--custom-resources",
+        "{}",
+        "rbac.authorization.k8s.io/v1/ClusterRole=",
+        "v1/ServiceAccount=m",
+    ]
+
+
+WATCHER_SCRIPT = """
+import json, sys
+from unittest import mock
+
+import drift_watcher
+
+drift_watcher.SUPERVISE_INTERVAL = 0
+with mock.patch("lightkube.Client"), mock.patch("threading.Thread") as thread:
+    drift_watcher.main(sys.argv[1:])
+watched = [call.kwargs["args"][1].__name__ for call in thread.call_args_list]
+print(json.dumps({"watched": watched, "manifests": "manifests" in sys.modules}))
+"""
+
+
+def test_drift_watcher_watches_custom_resources(harness, tmp_path, monkeypatch):
+    harness.update_config(
+        {
+            "external-data": True,
+            "external-data-providers": "tags:\n  url: https://tags.example/\n",
+        }
+    )
+    # the charm's real resources, including its Config and Provider
+    monkeypatch.setattr(
+        "manifests.ControllerManagerManifests.resources",
+        property(lambda self: self.manifest_resources()),
+    )
+    arguments = harness.charm.drift_watcher.arguments()
+    # a new interpreter, which like the watcher doesn't import the manifests
+    result = subprocess.run(
+        [sys.executable, "-c", WATCHER_SCRIPT]
+        + ["--pid-file", str(tmp_path / "drift-watcher.pid"), *arguments],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    output = json.loads(result.stdout)
+    assert not output["manifests"]
+    assert {"Config", "Provider", "CustomResourceDefinition"} <= set(output["watched"])
+    assert len(output["watched"]) == len([arg for arg in arguments if "=" in arg])
+    assert "Not watching" not in result.stderr
+
+
+def test_drift_watcher_flags_changes(monkeypatch):
+    class Stop(Exception):
+        pass
+
+    def obj(generation, labels=None):
+        return from_dict(
+            {
+                "apiVersion": "rbac.authorization.k8s.io/v1",
+                "kind": "ClusterRole",
+                "metadata": {
+                    "name": "gatekeeper-manager-role",
+                    "generation": generation,
+                    "labels": labels,
+                },
+            }
+        )
+
+    response = httpx.Response(
+        500,
+        json={"kind": "Status", "code": 500, "message": "connection lost"},
+        request=httpx.Request("GET", "https://apiserver"),
+    )
+    error = ApiError(request=response.request, response=response)
+
+    def watch():
+        yield "ADDED", obj(1)
+        # status only
+        yield "MODIFIED", obj(1)
+        yield "MODIFIED", obj(2)
+        yield "MODIFIED", obj(2, labels={"juju.io/manifest": "other"})
+        yield "DELETED", obj(2)
+        yield "ADDED", obj(3)
+        raise error
+
+    client, changed, sleep = MagicMock(), MagicMock(), MagicMock()
+    client.watch.side_effect = [watch(), error, error, Stop()]
+    # unchanged while the watch fails, until the object is modified
+    client.list.side_effect = [[obj(3)], [obj(3)], [obj(4)]]
+    monkeypatch.setattr("drift_watcher.time.sleep", sleep)
+    with pytest.raises(Stop):
+        drift_watcher._watch(client, StatefulSet, None, {}, changed)
+    assert changed.set.call_count == 4
+    # failures back off exponentially
+    assert [call.args[0] for call in sleep.call_args_list] == [5.0, 10.0, 20.0]
+
+
+def test_drift_watcher_stop_ignores_other_process(tmp_path, monkeypatch):
+    kill = MagicMock()
+    monkeypatch.setattr("drift_watcher.os.kill", kill)
+    pid_file = tmp_path / "drift-watcher.pid"
+    # a pid reused by another process
+    pid_file.write_text(str(os.getpid()))
+    drift_watcher.stop_watcher(pid_file)
+    kill.assert_not_called()
+    assert not pid_file.exists()
+
+
+def test_resources_changed_updates_status(harness, active_container, drifted_role):
+    harness.charm.on.resources_changed.emit()
+    assert harness.charm.unit.status == BlockedStatus(
+        "Missing resources, to reconcile run: "
+        f"`juju run {harness.charm.unit.name} reconcile-resources`"
+    )
+
+
 def test_gatekeeper_pebble_ready(harness, lk_client, mock_installed_resources):
     expected_plan = {
         "checks": {
@@ -111,6 +840,27 @@ def test_gatekeeper_pebble_ready(harness, lk_client, mock_installed_resources):
     assert patch.call_args[1]["namespace"] == "gatekeeper-model"
 
 
+def test_pod_placement(harness, lk_client):
+    harness.charm._patch_statefulset()
+    pod_spec = lk_client.patch.call_args.kwargs["obj"]["spec"]["template"]["spec"]
+    assert pod_spec["affinity"] == {"podAntiAffinity": None}
+    assert pod_spec["priorityClassName"] == "system-cluster-critical"
+
+    lk_client.patch.reset_mock()
+    harness.update_config(
+        {"node-selector": "pool=gatekeeper", "tolerations": "dedicated:NoSchedule"}
+    )
+    pod_spec = lk_client.patch.call_args.kwargs["obj"]["spec"]["template"]["spec"]
+    assert pod_spec["nodeSelector"] == {"$patch": "replace", "pool": "gatekeeper"}
+    assert pod_spec["tolerations"] == [
+        {"key": "dedicated", "operator": "Exists", "effect": "NoSchedule"}
+    ]
+
+    # the statefulset is only patched again when the patch changes
+    harness.update_config({"audit-interval": 120})
+    lk_client.patch.assert_called_once()
+
+
 def test_gatekeeper_pebble_ready_already_started(harness, active_container, caplog):
     with caplog.at_level(logging.INFO):
         harness.charm.on.gatekeeper_pebble_ready.emit(active_container)
@@ -162,3 +912,299 @@ def test_config_changed(harness, active_container, caplog):
     actual_plan = harness.charm._gatekeeper_layer()
     assert expected_plan == actual_plan
     active_container.restart.assert_called_once()
+
+
+def test_alert_rules_published(harness):
+    rel_id = harness.add_relation("metrics-endpoint", "prometheus-k8s")
+    harness.add_relation_unit(rel_id, "prometheus-k8s/0")
+    alert_rules = json.loads(
+        harness.get_relation_data(rel_id, harness.charm.app.name)["alert_rules"]
+    )
+    rules = [r for g in alert_rules["groups"] for r in g["rules"]]
+    records = {r["record"] for r in rules if "record" in r}
+    alerts = {r["alert"] for r in rules if "alert" in r}
+    assert records == {
+        "gatekeeper:audit_duration_seconds:avg30m",
+        "gatekeeper:audit_duty_cycle:ratio30m",
+        "gatekeeper:audit_last_run_age_seconds",
+        "gatekeeper:violations:sum",
+    }
+    assert alerts == {"GatekeeperAuditOverrunningInterval"}
+
+
+def test_scrape_config_limits(harness):
+    rel_id = harness.add_relation("metrics-endpoint", "prometheus-k8s")
+    harness.add_relation_unit(rel_id, "prometheus-k8s/0")
+    harness.update_config(
+        {
+            "metrics-scrape-interval": "1m",
+            "metrics-scrape-timeout": "not-a-duration",
+            "metrics-keep": "gatekeeper_.*",
+            "metrics-drop": "gatekeeper_constraint_templates",
+        }
+    )
+    job, charm_job = json.loads(
+        harness.get_relation_data(rel_id, harness.charm.app.name)["scrape_jobs"]
+    )
+    assert job["static_configs"] == [{"targets": ["*:8888"]}]
+    assert charm_job["static_configs"] == [{"targets": ["*:8889"]}]
+    assert job["scrape_interval"] == "1m"
+    assert "scrape_timeout" not in job
+    assert job["metric_relabel_configs"] == [
+        {"source_labels": ["__name__"], "regex": "gatekeeper_.*", "action": "keep"},
+        {
+            "source_labels": ["__name__"],
+            "regex": "gatekeeper_constraint_templates",
+            "action": "drop",
+        },
+    ]
+
+    # the library publishing its jobs again keeps the metric relabelling
+    harness.update_relation_data(rel_id, "prometheus-k8s", {"event": "{}"})
+    job, _ = json.loads(
+        harness.get_relation_data(rel_id, harness.charm.app.name)["scrape_jobs"]
+    )
+    assert len(job["metric_relabel_configs"]) == 2
+
+
+def test_charm_metrics(harness, lk_client, monkeypatch):
+    monkeypatch.setattr(
+        "manifests.ControllerManagerManifests.apply_manifests",
+        MagicMock(side_effect=ManifestClientError("apiserver unavailable")),
+    )
+    harness.update_config({"api-retry-budget": 0})
+    metrics = harness.charm.charm_metrics
+    metrics.hook = "install"
+    metrics._api_requests.clear()
+    metrics._deferred.clear()
+
+    harness.charm._stored.statefulset_patch = None
+    harness.charm._patch_statefulset()
+    harness.charm.on.install.emit()
+    metrics.record(0.3)
+    # published once the exporter's container is up
+    harness.container_pebble_ready("charm-metrics")
+
+    container = harness.model.unit.get_container("charm-metrics")
+    service = container.get_plan().services["charm-metrics"]
+    assert service.command == "httpd -f -p 8889 -h /var/lib/charm-metrics"
+    exposition = container.pull("/var/lib/charm-metrics/metrics.txt").read()
+    assert (
+        'gatekeeper_charm_hook_duration_seconds_bucket{hook="install",le="0.25"} 0'
+        in exposition
+    )
+    assert (
+        'gatekeeper_charm_hook_duration_seconds_bucket{hook="install",le="0.5"} 1'
+        in exposition
+    )
+    assert (
+        'gatekeeper_charm_hook_duration_seconds_count{hook="install"} 1' in exposition
+    )
+    assert (
+        'gatekeeper_charm_api_requests_total{hook="install",method="patch"} 1'
+        in exposition
+    )
+    assert (
+        'gatekeeper_charm_deferred_events_total{hook="install",reason="ManifestClientError"} 1'
+        in exposition
+    )
+
+
+def test_audit_autotune(harness, active_container, monkeypatch):
+    harness.update_config({"audit-autotune": True, "audit-interval": 60})
+    active_container.restart.reset_mock()
+    observe = MagicMock(
+        return_value=AuditObservation(
+            runs=2, duration_total=100.0, last_run=1000.0, memory=450 * 2**20
+        )
+    )
+    monkeypatch.setattr("charm.observe_audit", observe)
+
+    harness.charm.on.update_status.emit()
+    command = active_container.get_plan().services["gatekeeper"].command
+    assert "--audit-chunk-size=250 " in command
+    assert "--audit-interval=75 " in command
+    active_container.restart.assert_called_once()
+
+    # the same audit again changes nothing
+    active_container.restart.reset_mock()
+    harness.charm.on.update_status.emit()
+    active_container.restart.assert_not_called()
+
+    # a cheap audit with memory to spare grows the chunk size back
+    observe.return_value = AuditObservation(
+        runs=1, duration_total=10.0, last_run=2000.0, memory=100 * 2**20
+    )
+    harness.charm.on.update_status.emit()
+    command = active_container.get_plan().services["gatekeeper"].command
+    assert "--audit-chunk-size=313 " in command
+    assert "--audit-interval=60 " in command
+    active_container.restart.assert_called_once()
+
+
+def test_audit_autotune_kept_across_config_changes(
+    harness, active_container, monkeypatch
+):
+    harness.update_config({"audit-autotune": True, "audit-interval": 60})
+    observe = MagicMock(
+        return_value=AuditObservation(
+            runs=2, duration_total=100.0, last_run=1000.0, memory=450 * 2**20
+        )
+    )
+    monkeypatch.setattr("charm.observe_audit", observe)
+    harness.charm.on.update_status.emit()
+    active_container.restart.reset_mock()
+
+    # neither an unrelated option nor a config-changed without changes, e.g.
+    # after a pod restart, discards the tuned values
+    harness.update_config({"metrics-keep": "gatekeeper_.*"})
+    harness.charm.on.config_changed.emit()
+    command = active_container.get_plan().services["gatekeeper"].command
+    assert "--audit-chunk-size=250 " in command
+    assert "--audit-interval=75 " in command
+    active_container.restart.assert_not_called()
+
+    # changing a tuning option starts over from the configured values
+    harness.update_config({"audit-interval-max": 1800})
+    command = active_container.get_plan().services["gatekeeper"].command
+    assert "--audit-chunk-size=500 " in command
+    assert "--audit-interval=60 " in command
+    active_container.restart.assert_called_once()
+
+
+def test_audit_autotune_keeps_chunk_size(harness, active_container, monkeypatch):
+    harness.update_config({"audit-autotune": True, "audit-interval": 60})
+    active_container.restart.reset_mock()
+    # without a memory metric, the chunk size isn't grown
+    observe = MagicMock(
+        return_value=AuditObservation(
+            runs=1, duration_total=10.0, last_run=1000.0, memory=0.0
+        )
+    )
+    monkeypatch.setattr("charm.observe_audit", observe)
+    harness.charm.on.update_status.emit()
+    active_container.restart.assert_not_called()
+
+    # a chunk size of 0 (unlimited) is never tuned, whatever the memory
+    harness.update_config({"audit-chunk-size": 0})
+    active_container.restart.reset_mock()
+    observe.return_value = AuditObservation(
+        runs=1, duration_total=10.0, last_run=2000.0, memory=450 * 2**20
+    )
+    harness.charm.on.update_status.emit()
+    command = active_container.get_plan().services["gatekeeper"].command
+    assert "--audit-chunk-size=0 " in command
+    active_container.restart.assert_not_called()
+
+
+def test_install_retries_apiserver_errors(harness, monkeypatch, caplog):
+    apply_manifests = MagicMock(
+        side_effect=[ManifestClientError("apiserver unavailable"), None]
+    )
+    monkeypatch.setattr(
+        "manifests.ControllerManagerManifests.apply_manifests", apply_manifests
+    )
+    sleep = MagicMock()
+    monkeypatch.setattr("retry.time.sleep", sleep)
+    event = MagicMock()
+
+    with caplog.at_level(logging.INFO):
+        harness.charm._install_or_upgrade(event)
+    assert apply_manifests.call_count == 2
+    sleep.assert_called_once()
+    event.defer.assert_not_called()
+    assert "Succeeded after 2 attempts" in caplog.text
+
+
+def test_install_defers_after_retry_budget(harness, monkeypatch):
+    apply_manifests = MagicMock(side_effect=ManifestClientError("apiserver down"))
+    monkeypatch.setattr(
+        "manifests.ControllerManagerManifests.apply_manifests", apply_manifests
+    )
+    clock = iter(range(0, 1000, 20))
+    monkeypatch.setattr("retry.time.monotonic", lambda: next(clock))
+    monkeypatch.setattr("retry.time.sleep", MagicMock())
+    event = MagicMock()
+
+    harness.charm._install_or_upgrade(event)
+    assert apply_manifests.call_count == 3
+    event.defer.assert_called_once()
+    assert harness.charm.unit.status == WaitingStatus("Waiting for kube-apiserver")
+
+
+def test_api_rate_limit(harness, lk_client, monkeypatch):
+    sleep = MagicMock()
+    monkeypatch.setattr("ratelimit.time.sleep", sleep)
+    monkeypatch.setattr("ratelimit.time.monotonic", lambda: 100.0)
+    harness.charm.rate_limiter.bucket = TokenBucket(qps=10, burst=2)
+    metrics = harness.charm.charm_metrics
+
+    for _ in range(3):
+        harness.charm.client.get(StatefulSet, "gatekeeper")
+    sleep.assert_called_once_with(pytest.approx(0.1))
+    assert metrics._throttled["client"] == (1, pytest.approx(0.1))
+
+
+def test_api_too_many_requests(harness, lk_client, monkeypatch):
+    sleep = MagicMock()
+    monkeypatch.setattr("ratelimit.time.sleep", sleep)
+    response = httpx.Response(
+        429,
+        headers={"Retry-After": "2"},
+        json={"kind": "Status", "code": 429, "message": "too many requests"},
+        request=httpx.Request("GET", "https://apiserver"),
+    )
+    lk_client.get.side_effect = [
+        ApiError(request=response.request, response=response),
+        "statefulset",
+    ]
+
+    assert harness.charm.client.get(StatefulSet, "gatekeeper") == "statefulset"
+    sleep.assert_called_once_with(2.0)
+    assert harness.charm.charm_metrics._throttled["server"] == (1, 2.0)
+
+
+def test_dispatch_imports(monkeypatch, mocked_service_patch):
+    # the API client, the manifests and the charm libraries are left to the
+    # handlers using them
+    imported = subprocess.run(
+        [sys.executable, "-c", "import sys, charm; print(*sys.modules)"],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.split()
+    heavy = {
+        "charms.observability_libs.v1.kubernetes_service_patch",
+        "charms.prometheus_k8s.v0.prometheus_scrape",
+        "lightkube",
+        "manifests",
+        "ops.manifests",
+    }
+    assert not heavy.intersection(imported)
+
+    # nor does update-status need the libraries
+    from charm import OPAAuditCharm
+
+    monkeypatch.setenv("JUJU_DISPATCH_PATH", "hooks/update-status")
+    harness = ops.testing.Harness(OPAAuditCharm)
+    harness.begin()
+    assert not hasattr(harness.charm, "metrics_endpoint")
+    mocked_service_patch.assert_not_called()
+    harness.cleanup()
+
+
+def test_config_changed_without_libs(monkeypatch, mocked_service_patch):
+    # a deferred config-changed is re-emitted in the dispatches without the
+    # libraries, and still publishes the scrape jobs
+    from charm import OPAAuditCharm
+
+    monkeypatch.setenv("JUJU_DISPATCH_PATH", "hooks/update-status")
+    harness = ops.testing.Harness(OPAAuditCharm)
+    harness.set_leader(True)
+    rel_id = harness.add_relation("metrics-endpoint", "prometheus-k8s")
+    harness.add_relation_unit(rel_id, "prometheus-k8s/0")
+    harness.begin()
+    harness.charm.on.config_changed.emit()
+    jobs = harness.get_relation_data(rel_id, "gatekeeper-audit")["scrape_jobs"]
+    assert len(json.loads(jobs)) == 2
+    harness.cleanup()
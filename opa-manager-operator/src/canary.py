@@ -0,0 +1,318 @@
+"""Canary rollouts of changes to the gatekeeper pod template.
+
+With canary-rollout enabled, the leader keeps the StatefulSet's rolling update
+partitioned so that only the pod with the highest ordinal, the canary, runs a
+new revision of the pod template. It doesn't matter whether the charm patched
+the template or Juju changed the image. The leader then reads the canary's
+admission error rate and latency from its metrics endpoint. The revision is
+promoted to every pod once they have stayed within the thresholds for the soak
+time. A canary exceeding them blocks the rollout until it is aborted, which
+rolls the canary back to the revision the other pods run, or promoted anyway.
+"""
+
+import logging
+import math
+import re
+import time
+from typing import Dict, Optional
+from urllib.error import URLError
+from urllib.request import urlopen
+
+from ops.framework import Object, StoredState
+from ops.model import ActiveStatus, BlockedStatus, WaitingStatus
+
+log = logging.getLogger(__name__)
+
+METRICS_PORT = 8888
+REQUESTS = "gatekeeper_validation_request_count"
+DURATION_BUCKET = "gatekeeper_validation_request_duration_seconds_bucket"
+# Label of a StatefulSet's pods naming the revision of the template they run
+REVISION_LABEL = "controller-revision-hash"
+LATENCY_QUANTILE = 0.99
+LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def scrape_admission(url, timeout=5) -> Dict:
+    """Read the admission request counters of a gatekeeper metrics endpoint.
+
+    Returns:
+        The number of requests and errors, and the cumulative duration
+        histogram as counts by upper bound.
+    """
+    with urlopen(url, timeout=timeout) as response:
+        text = response.read().decode()
+
+    sample = {"requests": 0.0, "errors": 0.0, "buckets": {}}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        series, _, value = line.rpartition(" ")
+        name, _, labels = series.partition("{")
+        if name not in (REQUESTS, DURATION_BUCKET):
+            continue
+        try:
+            count = float(value)
+        except ValueError:
+            continue
+        labels = dict(LABEL.findall(labels))
+        if name == REQUESTS:
+            sample["requests"] += count
+            if labels.get("admission_status") == "error":
+                sample["errors"] += count
+        elif "le" in labels:
+            buckets = sample["buckets"]
+            buckets[labels["le"]] = buckets.get(labels["le"], 0.0) + count
+    return sample
+
+
+def quantile(q, buckets) -> Optional[float]:
+    """Estimate a quantile from cumulative histogram buckets, like Prometheus."""
+    bounds = sorted((float(le), count) for le, count in buckets.items())
+    if not bounds or bounds[-1][1] <= 0:
+        return None
+    rank = q * bounds[-1][1]
+    lower, below = 0.0, 0.0
+    for bound, count in bounds:
+        if count >= rank:
+            if math.isinf(bound):
+                return lower
+            return lower + (bound - lower) * (rank - below) / max(count - below, 1e-9)
+        lower, below = bound, count
+    return lower
+
+
+def evaluate(baseline, sample, max_error_rate, max_latency) -> Optional[str]:
+    """Describe how the canary exceeded a threshold since the baseline, if it did."""
+    requests = sample["requests"] - baseline["requests"]
+    if requests <= 0:
+        return None
+    error_rate = (sample["errors"] - baseline["errors"]) / requests
+    if error_rate > max_error_rate:
+        return f"admission error rate {error_rate:.2%} above {max_error_rate:.2%}"
+
+    buckets = {
+        le: count - baseline["buckets"].get(le, 0.0)
+        for le, count in sample["buckets"].items()
+    }
+    latency = quantile(LATENCY_QUANTILE, buckets)
+    if latency is not None and latency > max_latency:
+        return f"p99 admission latency {latency:.3f}s above {max_latency}s"
+    return None
+
+
+class CanaryRollout(Object):
+    """Roll new revisions of the pod template out to a canary pod first."""
+
+    _stored = StoredState()
+
+    def __init__(self, charm):
+        """Manage the rollouts.
+
+        @param charm:   the charm owning the StatefulSet, and its lightkube client
+        """
+        super().__init__(charm, "canary-rollout")
+        self.charm = charm
+        self.status = None
+        self._stored.set_default(
+            revision=None, since=None, baseline=None, failure=None, promoted=False
+        )
+        self.framework.observe(charm.on.leader_elected, self._on_leader_elected)
+        self.framework.observe(charm.on.update_status, self._on_update_status)
+        self.framework.observe(charm.on.promote_action, self._on_promote)
+        self.framework.observe(charm.on.abort_action, self._on_abort)
+
+    @property
+    def client(self):
+        return self.charm.client
+
+    @property
+    def enabled(self):
+        return self.charm.config["canary-rollout"]
+
+    @property
+    def partition(self):
+        """Ordinal from which pods run the latest revision of the pod template."""
+        if not self.enabled or self._stored.promoted:
+            return 0
+        return max(self.model.app.planned_units() - 1, 0)
+
+    def update_strategy(self):
+        """Fields of the StatefulSet spec partitioning its rolling update."""
+        return {
+            "updateStrategy": {
+                "type": "RollingUpdate",
+                "rollingUpdate": {"partition": self.partition},
+            }
+        }
+
+    def _statefulset(self):
+        from lightkube.resources.apps_v1 import StatefulSet
+
+        return self.client.get(
+            StatefulSet, name=self.model.app.name, namespace=self.model.name
+        )
+
+    def _set_partition(self, statefulset):
+        from lightkube.resources.apps_v1 import StatefulSet
+
+        strategy = statefulset.spec.updateStrategy
+        current = (
+            strategy and strategy.rollingUpdate and strategy.rollingUpdate.partition
+        ) or 0
+        if current == self.partition:
+            return
+        log.info(f"Partitioning the rolling update from ordinal {self.partition}")
+        self.client.patch(
+            StatefulSet,
+            name=self.model.app.name,
+            namespace=self.model.name,
+            obj={"spec": self.update_strategy()},
+        )
+
+    def _reset(self, revision=None):
+        self._stored.revision = revision
+        self._stored.since = None
+        self._stored.baseline = None
+        self._stored.failure = None
+        self._stored.promoted = False
+
+    def _on_leader_elected(self, _event):
+        # the soak of this unit's last leadership may have been overtaken since
+        self._reset()
+
+    def _on_update_status(self, _event):
+        if not (self.enabled and self.model.unit.is_leader()):
+            return
+        from lightkube import ApiError
+
+        try:
+            self._process()
+        except ApiError:
+            log.exception("Failed to process the canary rollout")
+
+    def _process(self):
+        from lightkube.resources.core_v1 import Pod
+
+        statefulset = self._statefulset()
+        status = statefulset.status
+        revision = status and status.updateRevision
+        if not revision or revision == status.currentRevision:
+            # every pod runs the latest revision, hold the next one at the canary
+            if self._stored.revision:
+                log.info(f"Rollout of revision {self._stored.revision} complete")
+            self._reset()
+            self._set_partition(statefulset)
+            return
+        if revision != self._stored.revision:
+            log.info(f"Rolling revision {revision} out to the canary")
+            self._reset(revision)
+
+        if self._stored.promoted:
+            self.status = ActiveStatus(f"Promoting revision {revision}")
+            self._set_partition(statefulset)
+            return
+
+        replicas = statefulset.spec.replicas or 0
+        canary = f"{self.model.app.name}-{max(replicas - 1, 0)}"
+        if self._stored.failure:
+            self.status = self._failed(canary)
+            return
+
+        pod = self.client.get(Pod, name=canary, namespace=self.model.name)
+        updated = (pod.metadata.labels or {}).get(REVISION_LABEL) == revision
+        if not (updated and _ready(pod)):
+            self.status = WaitingStatus(f"Canary {canary} updating to {revision}")
+            return
+
+        url = f"http://{pod.status.podIP}:{METRICS_PORT}/metrics"
+        try:
+            sample = scrape_admission(url)
+        except (URLError, OSError) as e:
+            log.warning(f"Failed to read the canary metrics from {url}: {e}")
+            self.status = WaitingStatus(f"Waiting for the metrics of canary {canary}")
+            return
+        if self._stored.baseline is None:
+            self._stored.baseline = sample
+            self._stored.since = time.time()
+
+        config = self.charm.config
+        if failure := evaluate(
+            self._stored.baseline,
+            sample,
+            config["canary-max-error-rate"],
+            config["canary-max-latency"],
+        ):
+            log.error(f"Canary {canary} of revision {revision} failed: {failure}")
+            self._stored.failure = failure
+            self.status = self._failed(canary)
+            return
+
+        remaining = self._stored.since + config["canary-soak-time"] - time.time()
+        if remaining > 0:
+            self.status = ActiveStatus(
+                f"Canary {canary} soaking, promoting in {math.ceil(remaining)}s"
+            )
+            return
+        log.info(f"Canary {canary} healthy, promoting revision {revision}")
+        self._promote(statefulset)
+
+    def _failed(self, canary):
+        return BlockedStatus(
+            f"Canary {canary} failed: {self._stored.failure}, run "
+            f"`juju run {self.model.unit.name} abort` or promote"
+        )
+
+    def _promote(self, statefulset):
+        self._stored.promoted = True
+        self._set_partition(statefulset)
+        self.status = ActiveStatus(f"Promoting revision {self._stored.revision}")
+
+    def _rollout(self, event):
+        """The StatefulSet if a revision is being rolled out, else fail the action."""
+        if not self.model.unit.is_leader():
+            event.fail("Only the leader unit manages rollouts")
+            return None
+        statefulset = self._statefulset()
+        status = statefulset.status
+        if not (status and status.updateRevision) or (
+            status.updateRevision == status.currentRevision
+        ):
+            event.fail("No rollout in progress")
+            return None
+        if status.updateRevision != self._stored.revision:
+            self._reset(status.updateRevision)
+        return statefulset
+
+    def _on_promote(self, event):
+        if not (statefulset := self._rollout(event)):
+            return
+        event.log(f"Promoting revision {self._stored.revision} to every unit")
+        self._promote(statefulset)
+        event.set_results({"revision": self._stored.revision})
+
+    def _on_abort(self, event):
+        from lightkube.resources.apps_v1 import ControllerRevision, StatefulSet
+
+        if not (statefulset := self._rollout(event)):
+            return
+        current = statefulset.status.currentRevision
+        event.log(f"Rolling the canary back to revision {current}")
+        revision = self.client.get(
+            ControllerRevision, name=current, namespace=self.model.name
+        )
+        # the revision holds the template as a patch replacing the current one,
+        # which resolves to the existing revision and so rolls the canary back
+        self.client.patch(
+            StatefulSet,
+            name=self.model.app.name,
+            namespace=self.model.name,
+            obj=revision.data,
+        )
+        aborted = self._stored.revision
+        self._reset()
+        event.set_results({"aborted": aborted, "revision": current})
+
+
+def _ready(pod):
+    conditions = (pod.status and pod.status.conditions) or []
+    return any(c.type == "Ready" and c.status == "True" for c in conditions)
@@ -0,0 +1,224 @@
+"""Prometheus metrics about the charm itself.
+
+Hook durations, Kubernetes API requests and deferred events are accumulated in
+the charm's stored state at the end of every dispatch, and rendered in the
+Prometheus text format into the charm-metrics container. Pebble runs a static
+file server there, so charm overhead can be scraped next to the workload
+metrics.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+from ops.framework import Object, StoredState
+from ops.pebble import Error as PebbleError
+
+log = logging.getLogger(__name__)
+
+EXPORTER_PORT = 8889
+CONTAINER = "charm-metrics"
+# served as text/plain, for its extension
+METRICS_PATH = "/metrics.txt"
+METRICS_DIR = "/var/lib/charm-metrics"
+LAYER = {
+    "summary": "Charm metrics exporter",
+    "services": {
+        CONTAINER: {
+            "override": "replace",
+            "summary": "Serve the charm metrics",
+            "command": f"httpd -f -p {EXPORTER_PORT} -h {METRICS_DIR}",
+            "startup": "enabled",
+        }
+    },
+}
+PREFIX = "gatekeeper_charm"
+BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+API_METHODS = frozenset(
+    {"apply", "create", "delete", "deletecollection", "get", "list", "patch", "replace"}
+)
+
+
+def _hook_name():
+    """Name of the hook or action being dispatched, e.g. update-status."""
+    dispatch_path = os.environ.get("JUJU_DISPATCH_PATH", "")
+    return dispatch_path.rsplit("/", 1)[-1] or "unknown"
+
+
+class _CountingClient:
+    """Proxy for a lightkube client counting the API requests made through it."""
+
+    def __init__(self, client, metrics):
+        self._client = client
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name not in API_METHODS:
+            return attr
+
+        def counted(*args, **kwargs):
+            self._metrics.count_api_request(name)
+            return attr(*args, **kwargs)
+
+        return counted
+
+
+class CharmMetrics(Object):
+    """Accumulate charm operation metrics and publish them after each hook."""
+
+    _stored = StoredState()
+
+    def __init__(self, charm, container_name=CONTAINER):
+        super().__init__(charm, "charm-metrics")
+        self._stored.set_default(state="{}")
+        self.container = charm.unit.get_container(container_name)
+        self.hook = _hook_name()
+        self._started = time.monotonic()
+        self._api_requests = {}
+        self._deferred = {}
+        self._throttled = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+        self.framework.observe(
+            charm.on[container_name].pebble_ready, self._on_pebble_ready
+        )
+        # the stored state is saved after commit, so this is recorded before
+        self.framework.observe(self.framework.on.pre_commit, self._on_pre_commit)
+
+    def instrument(self, client):
+        """Wrap a lightkube client so that its API requests are counted."""
+        return _CountingClient(client, self)
+
+    def count_api_request(self, method):
+        with self._lock:
+            self._api_requests[method] = self._api_requests.get(method, 0) + 1
+
+    def count_deferred(self, reason):
+        self._deferred[reason] = self._deferred.get(reason, 0) + 1
+
+    def count_throttled(self, source, seconds):
+        """Count a request delayed by the client rate limiter or the API server."""
+        with self._lock:
+            count, total = self._throttled.get(source, (0, 0.0))
+            self._throttled[source] = (count + 1, total + seconds)
+
+    def set_gauge(self, name, value, description):
+        """Set gatekeeper_charm_<name> to value, until it is set again."""
+        self._gauges[name] = {"value": value, "help": description}
+
+    def _on_pebble_ready(self, _event):
+        self.publish()
+        self.container.add_layer(CONTAINER, LAYER, combine=True)
+        self.container.replan()
+
+    def _on_pre_commit(self, _event):
+        self.record(time.monotonic() - self._started)
+        self.publish()
+
+    def record(self, duration):
+        """Merge this hook's measurements into the stored state."""
+        state = load_state(self._stored.state)
+        hook = state["hooks"].setdefault(
+            self.hook, {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+        )
+        for i, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                hook["buckets"][i] += 1
+        hook["sum"] += duration
+        hook["count"] += 1
+
+        for method, count in self._api_requests.items():
+            key = f"{self.hook}/{method}"
+            state["api_requests"][key] = state["api_requests"].get(key, 0) + count
+        for reason, count in self._deferred.items():
+            key = f"{self.hook}/{reason}"
+            state["deferred"][key] = state["deferred"].get(key, 0) + count
+        for source, (count, seconds) in self._throttled.items():
+            key = f"{self.hook}/{source}"
+            throttled = state["throttled"].setdefault(key, {"count": 0, "seconds": 0.0})
+            throttled["count"] += count
+            throttled["seconds"] += seconds
+        state["gauges"].update(self._gauges)
+        self._stored.state = json.dumps(state)
+
+    def publish(self):
+        """Render the metrics into the exporter's container, once it is up."""
+        if not self.container.can_connect():
+            return
+        try:
+            self.container.push(
+                f"{METRICS_DIR}{METRICS_PATH}",
+                render(load_state(self._stored.state)),
+                make_dirs=True,
+            )
+        except PebbleError:
+            log.exception("Failed to publish the charm metrics")
+
+
+def load_state(content):
+    try:
+        state = json.loads(content)
+    except ValueError:
+        state = {}
+    for key in ("hooks", "api_requests", "deferred", "throttled", "gauges"):
+        state.setdefault(key, {})
+    return state
+
+
+def render(state):
+    """Render the persisted state in the Prometheus text exposition format."""
+    name = f"{PREFIX}_hook_duration_seconds"
+    lines = [
+        f"# HELP {name} Time spent dispatching a charm hook or action.",
+        f"# TYPE {name} histogram",
+    ]
+    for hook, hist in sorted(state["hooks"].items()):
+        for bound, count in zip(BUCKETS, hist["buckets"]):
+            lines.append(f'{name}_bucket{{hook="{hook}",le="{bound}"}} {count}')
+        lines.append(f'{name}_bucket{{hook="{hook}",le="+Inf"}} {hist["count"]}')
+        lines.append(f'{name}_sum{{hook="{hook}"}} {hist["sum"]}')
+        lines.append(f'{name}_count{{hook="{hook}"}} {hist["count"]}')
+
+    name = f"{PREFIX}_api_requests_total"
+    lines += [
+        f"# HELP {name} Kubernetes API requests made by the charm.",
+        f"# TYPE {name} counter",
+    ]
+    for key, count in sorted(state["api_requests"].items()):
+        hook, method = key.rsplit("/", 1)
+        lines.append(f'{name}{{hook="{hook}",method="{method}"}} {count}')
+
+    name = f"{PREFIX}_deferred_events_total"
+    lines += [
+        f"# HELP {name} Events deferred by the charm.",
+        f"# TYPE {name} counter",
+    ]
+    for key, count in sorted(state["deferred"].items()):
+        hook, reason = key.rsplit("/", 1)
+        lines.append(f'{name}{{hook="{hook}",reason="{reason}"}} {count}')
+
+    count_name = f"{PREFIX}_api_throttled_total"
+    seconds_name = f"{PREFIX}_api_throttled_seconds_total"
+    lines += [
+        f"# HELP {count_name} API requests delayed by rate limiting.",
+        f"# TYPE {count_name} counter",
+        f"# HELP {seconds_name} Time API requests spent delayed by rate limiting.",
+        f"# TYPE {seconds_name} counter",
+    ]
+    for key, throttled in sorted(state["throttled"].items()):
+        hook, source = key.rsplit("/", 1)
+        labels = f'{{hook="{hook}",source="{source}"}}'
+        lines.append(f"{count_name}{labels} {throttled['count']}")
+        lines.append(f"{seconds_name}{labels} {throttled['seconds']}")
+
+    for gauge, sample in sorted(state["gauges"].items()):
+        name = f"{PREFIX}_{gauge}"
+        lines += [
+            f"# HELP {name} {sample['help']}",
+            f"# TYPE {name} gauge",
+            f"{name} {sample['value']}",
+        ]
+    return "\n".join(lines) + "\n"
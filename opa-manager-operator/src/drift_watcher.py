@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""Dispatch a charm hook as soon as the charm's Kubernetes resources change.
+
+Run as a script, this module watches every kind of resource the manifests
+install, filtered by the labels ManifestLabel sets, and runs the charm's
+resources-changed hook through juju-exec when one of them is modified or
+deleted. Missing and drifted resources are then reported right away rather
+than at the next update-status, and the watches cost nothing while idle.
+
+The charm starts the watcher on the leader at the end of every hook if it
+isn't running, and stops it when the unit loses leadership or is removed. The
+watcher exits by itself once its pid file no longer names it.
+"""
+
+import json
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+from ops.charm import EventBase
+from ops.framework import Object
+
+log = logging.getLogger(__name__)
+
+HOOK = "resources_changed"
+# Changes within this many seconds of each other are dispatched together
+DEBOUNCE = 2.0
+# Failed watches are retried after this delay, doubled on each further failure
+RETRY_INTERVAL = 5.0
+MAX_RETRY_INTERVAL = 300.0
+# Seconds between checks that this is still the unit's watcher
+SUPERVISE_INTERVAL = 30.0
+# Scopes of the custom resources
+NAMESPACED = "Namespaced"
+CLUSTER = "Cluster"
+
+
+class ResourcesChangedEvent(EventBase):
+    """A resource installed by the charm was modified or deleted."""
+
+
+class DriftWatcher(Object):
+    """Keep the watcher running on the leader unit."""
+
+    def __init__(self, charm, state_dir):
+        super().__init__(charm, "drift-watcher")
+        self.charm = charm
+        self.pid_file = Path(state_dir) / "drift-watcher.pid"
+        self._removing = False
+        # watch the kinds of the configured release, with the current code
+        self.framework.observe(charm.on.upgrade_charm, self._on_restart)
+        self.framework.observe(charm.on.config_changed, self._on_restart)
+        self.framework.observe(charm.on.remove, self._on_remove)
+        self.framework.observe(self.framework.on.commit, self._on_commit)
+
+    def _on_restart(self, _event):
+        stop_watcher(self.pid_file)
+
+    def _on_remove(self, _event):
+        self._removing = True
+
+    def _on_commit(self, _event):
+        try:
+            if self._removing or not self.model.unit.is_leader():
+                stop_watcher(self.pid_file)
+            elif not _running(self.pid_file):
+                start_watcher(self.pid_file, self.arguments())
+        except OSError:
+            log.exception("Failed to start the drift watcher")
+
+    def arguments(self):
+        from lightkube.core.resource import api_info
+        from lightkube.generic_resource import (
+            GenericGlobalResource,
+            GenericNamespacedResource,
+        )
+        from ops.manifests.literals import APP_LABEL, MANIFEST_LABEL
+
+        manifests = self.charm.manifests
+        kinds, custom_resources = set(), {}
+        for rsc in manifests.resources:
+            kind = f"{rsc.resource.apiVersion}/{rsc.kind}"
+            kinds.add(f"{kind}={rsc.namespace or ''}")
+            # the watcher doesn't import the manifests, which register these
+            if isinstance(rsc.resource, GenericNamespacedResource):
+                custom_resources[kind] = [api_info(rsc.resource).plural, NAMESPACED]
+            elif isinstance(rsc.resource, GenericGlobalResource):
+                custom_resources[kind] = [api_info(rsc.resource).plural, CLUSTER]
+        labels = {APP_LABEL: self.model.app.name, MANIFEST_LABEL: manifests.name}
+        return [
+            "--unit",
+            self.model.unit.name,
+            "--charm-dir",
+            str(self.charm.charm_dir),
+            "--labels",
+            json.dumps(labels),
+            "--custom-resources",
+            json.dumps(custom_resources, sort_keys=True),
+            *sorted(kinds),
+        ]
+
+
+def _running(pid_file):
+    """Whether the pid file names a live drift watcher, not a reused pid."""
+    try:
+        pid = int(pid_file.read_text())
+        command = Path(f"/proc/{pid}/cmdline").read_bytes()
+    except (OSError, ValueError):
+        return False
+    return Path(__file__).name.encode() in command
+
+
+def _owns(pid_file):
+    """Whether the pid file names this process."""
+    try:
+        return pid_file.read_text().strip() == str(os.getpid())
+    except OSError:
+        return False
+
+
+def start_watcher(pid_file, arguments):
+    log.info("Starting the drift watcher")
+    process = subprocess.Popen(
+        [sys.executable, __file__, "--pid-file", str(pid_file), *arguments],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    pid_file.write_text(str(process.pid))
+
+
+def stop_watcher(pid_file):
+    if _running(pid_file):
+        try:
+            os.kill(int(pid_file.read_text()), signal.SIGTERM)
+            log.info("Stopped the drift watcher")
+        except (OSError, ValueError):
+            pass
+    # a watcher which couldn't be signalled exits once it notices
+    pid_file.unlink(missing_ok=True)
+
+
+def _fingerprint(obj):
+    """What identifies a change to the object that is not just a status update."""
+    meta = obj.metadata
+    if meta.generation:
+        return meta.generation, meta.labels, meta.annotations
+    return meta.resourceVersion
+
+
+def _watch(client, resource, namespace, labels, changed):
+    """Flag changed when any watched object is modified or deleted.
+
+    After a failed watch the objects are listed again, and changed is only
+    flagged if one of those seen before was modified or deleted meanwhile.
+    Repeated failures are retried less and less often.
+    """
+    from httpx import HTTPError
+    from lightkube import ApiError
+    from lightkube.core.exceptions import LoadResourceError
+
+    seen = {}
+    failures = 0
+    while True:
+        try:
+            if failures:
+                # changes may have been missed while reconnecting
+                listed = client.list(resource, namespace=namespace, labels=labels)
+                current = {
+                    (obj.metadata.namespace, obj.metadata.name): _fingerprint(obj)
+                    for obj in listed
+                }
+                if any(current.get(key) != value for key, value in seen.items()):
+                    changed.set()
+                seen = current
+            for op, obj in client.watch(resource, namespace=namespace, labels=labels):
+                failures = 0
+                key = obj.metadata.namespace, obj.metadata.name
+                fingerprint = _fingerprint(obj)
+                previous = seen.get(key)
+                if op == "DELETED":
+                    seen.pop(key, None)
+                    changed.set()
+                    continue
+                if previous is not None and previous != fingerprint:
+                    changed.set()
+                seen[key] = fingerprint
+        except (ApiError, HTTPError, LoadResourceError) as e:
+            failures += 1
+            delay = min(RETRY_INTERVAL * 2 ** (failures - 1), MAX_RETRY_INTERVAL)
+            log.warning(
+                f"Watch of {resource.__name__} failed ({e}), retrying in {delay:.0f}s"
+            )
+            time.sleep(delay)
+
+
+def dispatch(unit, charm_dir):
+    juju_exec = shutil.which("juju-exec") or shutil.which("juju-run")
+    command = f"JUJU_DISPATCH_PATH=hooks/{HOOK} {charm_dir}/dispatch"
+    log.info(f"Dispatching {HOOK} on {unit}")
+    subprocess.run([juju_exec, "-u", unit, command], check=False)
+
+
+def serve(unit, charm_dir, labels, custom_resources, kinds, pid_file):
+    from lightkube import Client
+    from lightkube.codecs import resource_registry
+    from lightkube.core.exceptions import LoadResourceError
+    from lightkube.generic_resource import (
+        create_global_resource,
+        create_namespaced_resource,
+    )
+
+    for kind, (plural, scope) in custom_resources.items():
+        api_version, kind = kind.rsplit("/", 1)
+        group, version = api_version.split("/")
+        create = (
+            create_namespaced_resource
+            if scope == NAMESPACED
+            else create_global_resource
+        )
+        create(group, version, kind, plural)
+
+    client = Client()
+    changed = threading.Event()
+    for kind in kinds:
+        kind, _, namespace = kind.partition("=")
+        api_version, kind = kind.rsplit("/", 1)
+        try:
+            resource = resource_registry.load(api_version, kind)
+        except LoadResourceError:
+            log.exception(f"Not watching {api_version} {kind}")
+            continue
+        threading.Thread(
+            target=_watch,
+            args=(client, resource, namespace or None, labels, changed),
+            daemon=True,
+        ).start()
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    while True:
+        if changed.wait(SUPERVISE_INTERVAL):
+            time.sleep(DEBOUNCE)
+            changed.clear()
+            dispatch(unit, charm_dir)
+        if not _owns(pid_file):
+            log.info("No longer the unit's drift watcher, exiting")
+            return
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pid-file", type=Path, required=True)
+    parser.add_argument("--unit", required=True)
+    parser.add_argument("--charm-dir", required=True)
+    parser.add_argument("--labels", type=json.loads, required=True)
+    parser.add_argument(
+        "--custom-resources",
+        type=json.loads,
+        default={},
+        help='plural and scope of each custom resource, e.g. {"API_VERSION/KIND": '
+        '["PLURAL", "Namespaced"]}',
+    )
+    parser.add_argument("kinds", nargs="+", metavar="API_VERSION/KIND=NAMESPACE")
+    args = parser.parse_args(argv)
+    serve(
+        args.unit,
+        args.charm_dir,
+        args.labels,
+        args.custom_resources,
+        args.kinds,
+        args.pid_file,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Gatekeeper external data providers declared in the charm config.
+
+The external-data-providers option is a YAML mapping of provider names to the
+spec of the Provider resource letting policies look data up from them, e.g.
+
+    cosign:
+      url: https://cosign-provider.cosign:8090/validate
+      caBundle: LS0tLS1CRUdJTi...
+      timeout: 5
+
+Gatekeeper caches the responses a provider marks as idempotent, for the
+configured cache TTL, so that admissions of the same keys don't each call the
+provider. The TTL can only be configured from gatekeeper 3.11. A provider can
+be queried from the charm to check that it answers and that its responses are
+cacheable.
+"""
+
+import base64
+import json
+import logging
+import re
+import ssl
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.request import Request, urlopen
+
+import yaml
+
+log = logging.getLogger(__name__)
+
+PROVIDER_API_VERSION = "externaldata.gatekeeper.sh/v1alpha1"
+REQUEST_API_VERSION = "externaldata.gatekeeper.sh/v1beta1"
+SPEC_FIELDS = frozenset({"url", "timeout", "caBundle", "insecureTLSSkipVerify"})
+# A Go duration, e.g. 3m or 1m30s
+GO_DURATION = re.compile(r"^(\d+(\.\d+)?(ns|us|µs|ms|s|m|h))+$")
+# The first gatekeeper release with --external-data-provider-response-cache-ttl
+CACHE_TTL_RELEASE = (3, 11)
+
+
+def parse_providers(*values: str) -> Dict[str, Dict]:
+    """Parse external-data-providers options into Provider specs by name.
+
+    The first option declaring a provider wins, so the charm's own options are
+    passed before those contributed by a related application.
+    """
+    providers: Dict[str, Dict] = {}
+    for value in values:
+        try:
+            declared = yaml.safe_load(value) or {}
+        except yaml.YAMLError as e:
+            log.error(f"Ignoring external-data-providers: {e}")
+            continue
+        if not isinstance(declared, dict):
+            log.error("Ignoring external-data-providers: not a mapping of providers")
+            continue
+        for name, spec in declared.items():
+            if not isinstance(spec, dict) or not spec.get("url"):
+                log.error(f"Ignoring provider {name}: its url is missing")
+                continue
+            if unknown := set(spec) - SPEC_FIELDS:
+                log.error(f"Ignoring provider {name}: unknown {', '.join(unknown)}")
+                continue
+            providers.setdefault(str(name), spec)
+    return providers
+
+
+def provider_resources(providers: Dict[str, Dict], timeout: int) -> List[Dict]:
+    """Provider resources, timing out after timeout seconds unless set per provider."""
+    return [
+        {
+            "apiVersion": PROVIDER_API_VERSION,
+            "kind": "Provider",
+            "metadata": {"name": name},
+            "spec": {"timeout": timeout, **spec},
+        }
+        for name, spec in sorted(providers.items())
+    ]
+
+
+def image_release(image: str) -> Optional[str]:
+    """The release in an image's tag, e.g. v3.11.0 for openpolicyagent/gatekeeper:v3.11.0."""
+    match = re.search(r":(v?\d+\.\d+(?:\.\d+)?)(?:@sha256:[0-9a-f]+)?$", image or "")
+    return match[1] if match else None
+
+
+def _minor_release(release: str) -> Tuple[int, int]:
+    """The major and minor version of a release, e.g. (3, 10) for v3.10.0."""
+    match = re.match(r"^v?(\d+)\.(\d+)", release or "")
+    return (int(match[1]), int(match[2])) if match else (0, 0)
+
+
+def flags(config, workload_release: Callable[[], Optional[str]]) -> str:
+    """Gatekeeper command line flags enabling external data, if it is enabled.
+
+    @param config:            the charm config
+    @param workload_release:  returns the gatekeeper release running, e.g. v3.11.0,
+                              or None if unknown; only called with a cache TTL
+    """
+    if not config["external-data"]:
+        return ""
+    flags = "--enable-external-data "
+    if ttl := config["external-data-cache-ttl"]:
+        if not GO_DURATION.match(ttl):
+            log.error(f"Ignoring external-data-cache-ttl={ttl}: not a Go duration")
+        elif not (release := workload_release()):
+            log.error(
+                f"Ignoring external-data-cache-ttl={ttl}: "
+                "the gatekeeper image's tag has no release"
+            )
+        elif _minor_release(release) < CACHE_TTL_RELEASE:
+            log.error(
+                f"Ignoring external-data-cache-ttl={ttl}: "
+                f"not supported by gatekeeper {release}, only from 3.11"
+            )
+        else:
+            flags += f"--external-data-provider-response-cache-ttl={ttl} "
+    return flags
+
+
+def _ssl_context(spec):
+    if spec.get("insecureTLSSkipVerify"):
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        return context
+    if ca_bundle := spec.get("caBundle"):
+        return ssl.create_default_context(cadata=base64.b64decode(ca_bundle).decode())
+    return None
+
+
+def query_provider(spec: Dict, keys: List[str], timeout: float) -> Tuple[Dict, float]:
+    """Send keys to a provider the way gatekeeper does.
+
+    Returns:
+        The provider's response and the seconds it took to answer.
+    """
+    body = {
+        "apiVersion": REQUEST_API_VERSION,
+        "kind": "ProviderRequest",
+        "request": {"keys": keys},
+    }
+    request = Request(
+        spec["url"],
+        data=json.dumps(body).encode(),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    started = time.monotonic()
+    with urlopen(request, timeout=timeout, context=_ssl_context(spec)) as response:
+        answer = json.loads(response.read())
+    return answer.get("response") or {}, time.monotonic() - started
@@ -0,0 +1,96 @@
+"""Placement of the gatekeeper pods on the cluster's nodes.
+
+The node-selector, tolerations, anti-affinity and priority-class options are
+turned into fields of the StatefulSet's pod template, so that gatekeeper can be
+pinned to dedicated nodes away from noisy workloads. Unset options clear their
+field, so that a config change never leaves a stale constraint behind.
+"""
+
+import logging
+import re
+from typing import Dict, List, Optional
+
+log = logging.getLogger(__name__)
+
+EFFECTS = frozenset({"NoSchedule", "PreferNoSchedule", "NoExecute"})
+ANTI_AFFINITY_TERMS = {
+    "preferred": "preferredDuringSchedulingIgnoredDuringExecution",
+    "required": "requiredDuringSchedulingIgnoredDuringExecution",
+}
+# A label key with an optional prefix, e.g. node-role.kubernetes.io/gatekeeper
+LABEL_KEY = re.compile(r"^([a-z0-9]([-a-z0-9.]*[a-z0-9])?/)?[A-Za-z0-9]([-.\w]*\w)?$")
+
+
+def node_selector(value) -> Optional[Dict[str, str]]:
+    """Parse a node-selector option of comma separated key=value pairs."""
+    selector = {}
+    for pair in filter(None, (p.strip() for p in value.split(","))):
+        key, sep, label = pair.partition("=")
+        if not sep or not LABEL_KEY.match(key.strip()):
+            log.error(f"Ignoring node-selector {pair}: not a key=value pair")
+            continue
+        selector[key.strip()] = label.strip()
+    if not selector:
+        return None
+    # a strategic merge would keep the labels of a previous selector
+    return {"$patch": "replace", **selector}
+
+
+def tolerations(value) -> Optional[List[dict]]:
+    """Parse a tolerations option in the syntax of `kubectl taint`.
+
+    Each space or comma separated taint is tolerated, e.g.
+    dedicated=gatekeeper:NoSchedule tolerates exactly that taint, while
+    dedicated:NoSchedule tolerates it whatever its value and dedicated
+    tolerates it whatever its value and effect.
+    """
+    tolerated = []
+    for taint in value.replace(",", " ").split():
+        key_value, _, effect = taint.partition(":")
+        key, sep, taint_value = key_value.partition("=")
+        if not LABEL_KEY.match(key) or (effect and effect not in EFFECTS):
+            log.error(f"Ignoring toleration {taint}: not a key[=value][:effect] taint")
+            continue
+        toleration = {"key": key, "operator": "Equal" if sep else "Exists"}
+        if sep:
+            toleration["value"] = taint_value
+        if effect:
+            toleration["effect"] = effect
+        tolerated.append(toleration)
+    return tolerated or None
+
+
+def anti_affinity(value, app) -> Optional[dict]:
+    """Keep the application's pods on distinct nodes, if preferred or required."""
+    if value not in ANTI_AFFINITY_TERMS:
+        if value != "none":
+            log.error(
+                f"Ignoring anti-affinity {value}: not preferred, required or none"
+            )
+        return None
+
+    term = {
+        "labelSelector": {
+            "matchExpressions": [
+                {"key": "app.kubernetes.io/name", "operator": "In", "values": [app]}
+            ],
+        },
+        "topologyKey": "kubernetes.io/hostname",
+    }
+    if value == "preferred":
+        term = {"podAffinityTerm": term, "weight": 100}
+    # the terms are lists which a strategic merge replaces, so clear the other one
+    return {
+        field: [term] if key == value else None
+        for key, field in ANTI_AFFINITY_TERMS.items()
+    }
+
+
+def pod_placement(config, app) -> dict:
+    """Fields of the pod spec placing the application's pods as configured."""
+    return {
+        "affinity": {"podAntiAffinity": anti_affinity(config["anti-affinity"], app)},
+        "nodeSelector": node_selector(config["node-selector"]),
+        "priorityClassName": config["priority-class"] or None,
+        "tolerations": tolerations(config["tolerations"]),
+    }
@@ -0,0 +1,142 @@
+"""Client-side rate limiting of the charm's Kubernetes API traffic.
+
+A token bucket limits the charm to `api-qps` requests per second with bursts
+of up to `api-burst` requests, so that large listings and reconciliations don't
+compete with the admission traffic gatekeeper serves. Requests the API server
+rejects with 429 Too Many Requests are retried after its Retry-After delay.
+"""
+
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+TOO_MANY_REQUESTS = 429
+MAX_RETRIES = 5
+MAX_RETRY_AFTER = 30.0
+API_METHODS = frozenset(
+    {"apply", "create", "delete", "deletecollection", "get", "patch", "replace"}
+)
+
+
+def _retry_after(error, attempt):
+    """Seconds to wait before retrying a request rejected with 429."""
+    try:
+        delay = float(error.response.headers["Retry-After"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        delay = 2.0 ** (attempt - 1)
+    return min(max(delay, 0.0), MAX_RETRY_AFTER)
+
+
+class TokenBucket:
+    """Allow qps requests per second on average, with bursts of up to burst."""
+
+    def __init__(self, qps, burst):
+        self.qps = qps
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until one is available.
+
+        Returns:
+            The seconds spent waiting.
+        """
+        if self.qps <= 0:
+            return 0.0
+        # resources may be applied from several threads, which queue up here
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.qps)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+
+            wait = (1 - self.tokens) / self.qps
+            time.sleep(wait)
+            self.tokens = 0.0
+            self.updated = now + wait
+            return wait
+
+
+class RateLimiter:
+    """Shares one token bucket between every lightkube client of the charm."""
+
+    def __init__(self, qps, burst, metrics):
+        self.bucket = TokenBucket(qps, burst)
+        self.metrics = metrics
+
+    def wrap(self, client):
+        """Rate limit the API requests made through a lightkube client."""
+        return _RateLimitedClient(client, self)
+
+    def throttle(self):
+        if waited := self.bucket.acquire():
+            self.metrics.count_throttled("client", waited)
+
+    def backoff(self, error, attempt):
+        """Wait out a 429 response, or return False if the error is not retryable."""
+        status = getattr(getattr(error, "status", None), "code", None)
+        if status != TOO_MANY_REQUESTS or attempt > MAX_RETRIES:
+            return False
+        delay = _retry_after(error, attempt)
+        log.info(f"API server asked to retry in {delay:.1f}s (attempt {attempt})")
+        time.sleep(delay)
+        self.metrics.count_throttled("server", delay)
+        return True
+
+
+class _RateLimitedClient:
+    """Proxy for a lightkube client taking a token for every API request."""
+
+    def __init__(self, client, limiter):
+        self._client = client
+        self._limiter = limiter
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name == "list":
+            return self._list
+        if name not in API_METHODS:
+            return attr
+
+        def limited(*args, **kwargs):
+            from lightkube import ApiError
+
+            attempt = 0
+            while True:
+                attempt += 1
+                self._limiter.throttle()
+                try:
+                    return attr(*args, **kwargs)
+                except ApiError as e:
+                    if not self._limiter.backoff(e, attempt):
+                        raise
+
+        return limited
+
+    def _list(self, *args, **kwargs):
+        # the first page is requested on the first iteration, so a 429 can
+        # only be retried transparently before anything has been yielded
+        from lightkube import ApiError
+
+        attempt = 0
+        while True:
+            attempt += 1
+            self._limiter.throttle()
+            items = iter(self._client.list(*args, **kwargs))
+            try:
+                first = next(items)
+            except StopIteration:
+                return
+            except ApiError as e:
+                if not self._limiter.backoff(e, attempt):
+                    raise
+                continue
+            yield first
+            yield from items
+            return
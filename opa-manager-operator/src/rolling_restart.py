@@ -0,0 +1,124 @@
+"""Peer-coordinated rolling restarts of the gatekeeper workload.
+
+Units ask for a restart in their peer unit data. The leader grants the restart
+lock to at most `max-concurrent-restarts` units at a time, in unit order. A
+unit holding the lock restarts gatekeeper and only releases the lock once the
+restarted workload is ready, so the other replicas keep serving admissions
+while it warms up. Hooks never wait for the workload: readiness is checked
+again on the events signalling it may have changed, and on update-status.
+"""
+
+import logging
+
+from ops.framework import Object
+
+log = logging.getLogger(__name__)
+
+REQUESTED = "requested"
+RESTARTING = "restarting"
+
+
+def _unit_number(unit):
+    return int(unit.name.rsplit("/", 1)[-1])
+
+
+class RollingRestart(Object):
+    """Restart lock shared by the units of the application over a peer relation."""
+
+    def __init__(self, charm, relation_name, restart, ready, ready_events=()):
+        """Create the lock.
+
+        @param charm:          the charm owning the workload
+        @param relation_name:  name of the peer relation
+        @param restart:        callable restarting the workload
+        @param ready:          callable returning True once the restarted
+                               workload is ready to serve
+        @param ready_events:   events after which the workload may be ready,
+                               e.g. the recovery of its Pebble ready check
+        """
+        super().__init__(charm, relation_name)
+        self.charm = charm
+        self.relation_name = relation_name
+        self._restart = restart
+        self._ready = ready
+
+        events = charm.on[relation_name]
+        self.framework.observe(events.relation_changed, self._on_changed)
+        self.framework.observe(events.relation_departed, self._on_changed)
+        self.framework.observe(charm.on.leader_elected, self._on_changed)
+        self.framework.observe(charm.on.update_status, self._on_changed)
+        for event in ready_events:
+            self.framework.observe(event, self._on_changed)
+
+    @property
+    def _relation(self):
+        return self.model.get_relation(self.relation_name)
+
+    @property
+    def state(self):
+        """This unit's position in the restart protocol, empty when idle."""
+        if not (relation := self._relation):
+            return ""
+        return relation.data[self.model.unit].get("restart", "")
+
+    def request(self):
+        """Ask for the workload to be restarted once this unit holds the lock."""
+        if not (relation := self._relation):
+            # no peers to coordinate with yet
+            self._restart()
+            return
+        if self.state == RESTARTING:
+            # restart again once the current restart has finished
+            log.info("Restart already in progress, restarting again when granted")
+        relation.data[self.model.unit]["restart"] = REQUESTED
+        self._process()
+
+    def _on_changed(self, _event):
+        self._process()
+
+    def _process(self):
+        if self.model.unit.is_leader():
+            self._grant()
+
+        if not (relation := self._relation):
+            return
+        granted = relation.data[self.model.app].get("granted", "").split()
+        state = self.state
+        if state == REQUESTED and self.model.unit.name in granted:
+            log.info("Restart lock acquired, restarting gatekeeper")
+            relation.data[self.model.unit]["restart"] = RESTARTING
+            self._restart()
+            state = RESTARTING
+        if state == RESTARTING and self._check_ready():
+            log.info("Gatekeeper ready after restart, releasing the restart lock")
+            relation.data[self.model.unit]["restart"] = ""
+            if self.model.unit.is_leader():
+                self._grant()
+
+    def _check_ready(self):
+        if not self._ready():
+            log.info("Gatekeeper not ready yet, keeping the restart lock")
+            return False
+        return True
+
+    def _grant(self):
+        """Hand the lock to waiting units, up to the concurrency limit."""
+        if not (relation := self._relation):
+            return
+        units = [self.model.unit, *relation.units]
+        states = {unit.name: relation.data[unit].get("restart", "") for unit in units}
+
+        # units keep the lock until they report being idle again
+        granted = [
+            name
+            for name in relation.data[self.model.app].get("granted", "").split()
+            if states.get(name)
+        ]
+        for unit in sorted(units, key=_unit_number):
+            if len(granted) >= self.charm.config["max-concurrent-restarts"]:
+                break
+            if states[unit.name] == REQUESTED and unit.name not in granted:
+                granted.append(unit.name)
+
+        if relation.data[self.model.app].get("granted", "") != " ".join(granted):
+            relation.data[self.model.app]["granted"] = " ".join(granted)
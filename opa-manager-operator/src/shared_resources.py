@@ -0,0 +1,89 @@
+"""Single ownership of the resources both gatekeeper charms install.
+
+The audit and controller-manager charms load the same gatekeeper manifests, so
+both would apply the CRDs, RBAC and ResourceQuota. Once the applications are
+related, the controller manager publishes itself as the owner of those shared
+resources. The audit charm then leaves them out of its manifests, only checking
+that they are installed, and takes them back when the relation is removed.
+Settings of the other application which go into a shared resource, such as its
+exclusions from gatekeeper's Config, are published for the owner to merge.
+"""
+
+import logging
+from typing import Callable, Dict, List, Optional
+
+from ops.framework import Object
+
+log = logging.getLogger(__name__)
+
+SHARED_KINDS = frozenset(
+    {
+        "CustomResourceDefinition",
+        "ClusterRole",
+        "ClusterRoleBinding",
+        "Config",
+        "Provider",
+        "Role",
+        "RoleBinding",
+        "ResourceQuota",
+    }
+)
+
+
+class SharedResources(Object):
+    """Which of the related gatekeeper applications owns the shared resources."""
+
+    def __init__(
+        self,
+        charm,
+        relation_name,
+        owner,
+        contributions: Optional[Callable[[], Dict[str, str]]] = None,
+    ):
+        """Take part in the election.
+
+        @param charm:          the charm installing the manifests
+        @param relation_name:  name of the relation between the gatekeeper charms
+        @param owner:          whether this application owns the shared
+                               resources while related
+        @param contributions:  callable returning the settings this application
+                               contributes to the shared resources
+        """
+        super().__init__(charm, relation_name)
+        self.relation_name = relation_name
+        self.owner = owner
+        self._contributions = contributions or dict
+        self.framework.observe(charm.on[relation_name].relation_created, self._publish)
+        self.framework.observe(charm.on.leader_elected, self._publish)
+        self.framework.observe(charm.on.config_changed, self._publish)
+
+    def _publish(self, _event):
+        if not self.model.unit.is_leader():
+            return
+        for relation in self.model.relations[self.relation_name]:
+            data = relation.data[self.model.app]
+            if self.owner:
+                data["owner"] = self.model.app.name
+            for key, value in self._contributions().items():
+                if value:
+                    data[key] = value
+                else:
+                    data.pop(key, None)
+
+    def contributed(self, key) -> List[str]:
+        """Values the related applications contribute for a setting."""
+        return [
+            value
+            for relation in self.model.relations[self.relation_name]
+            if relation.app and (value := relation.data[relation.app].get(key))
+        ]
+
+    @property
+    def owned_elsewhere(self) -> Optional[str]:
+        """Name of the related application owning the shared resources, if any."""
+        for relation in self.model.relations[self.relation_name]:
+            if relation.app and relation.data[relation.app].get("owner") == (
+                relation.app.name
+            ):
+                return relation.app.name
+        return None
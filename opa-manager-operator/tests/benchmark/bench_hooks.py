@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+"""Benchmark of the charm's hooks and actions against an in-memory Kubernetes API.
+
+Seeds a `FakeKube` with gatekeeper's objects at the given scale, then runs the
+charm under `ops.testing.Harness` through install, pebble-ready, update-status
+and every action, each with a fresh lightkube client as under Juju. Reports the
+duration of each step and the API requests it made:
+
+    tox -e benchmark-hooks -- --constraint-kinds 1000 --violations 50000 \\
+        --crds 600 --latency 5
+
+The charm's `api-qps` rate limit is lifted unless given, so that the durations
+are those of the charm and the API rather than of the limit.
+"""
+
+import argparse
+import contextlib
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from functools import cached_property, partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock
+
+import lightkube
+import yaml
+from fake_kube import FakeKube
+from ops import CharmBase
+from ops.testing import ActionFailed, Harness
+
+import charm
+
+CHARM_DIR = Path(__file__).resolve().parents[2]
+MODEL = "bench"
+CRD_API = "apiextensions.k8s.io/v1"
+CONSTRAINTS_GROUP = "constraints.gatekeeper.sh"
+STATUS_API = "status.gatekeeper.sh/v1beta1"
+POD_LABEL = "internal.gatekeeper.sh/pod"
+TEMPLATE_LABEL = "internal.gatekeeper.sh/constrainttemplate-name"
+CONSTRAINT_LABEL = "internal.gatekeeper.sh/constraint-name"
+
+
+def crd(group, kind, plural, scope, version):
+    return {
+        "apiVersion": CRD_API,
+        "kind": "CustomResourceDefinition",
+        "metadata": {"name": f"{plural}.{group}"},
+        "spec": {
+            "group": group,
+            "names": {"kind": kind, "plural": plural, "singular": kind.lower()},
+            "scope": scope,
+            "versions": [{"name": version, "served": True, "storage": True}],
+        },
+    }
+
+
+def seed(api, app, args):
+    """Store the objects of a cluster running gatekeeper at the given scale."""
+    api.add(
+        "services",
+        {
+            "apiVersion": "v1",
+            "kind": "Service",
+            "metadata": {"name": app, "namespace": MODEL},
+            "spec": {"ports": [{"name": "placeholder", "port": 65535}]},
+        },
+    )
+    labels = {"app.kubernetes.io/name": app}
+    # a rollout in progress, for the rollout actions to act on
+    api.add(
+        "statefulsets",
+        {
+            "apiVersion": "apps/v1",
+            "kind": "StatefulSet",
+            "metadata": {"name": app, "namespace": MODEL, "labels": labels},
+            "spec": {
+                "replicas": args.units,
+                "selector": {"matchLabels": labels},
+                "serviceName": f"{app}-endpoints",
+                "template": {"metadata": {"labels": labels}},
+            },
+            "status": {
+                "replicas": args.units,
+                "currentRevision": f"{app}-1",
+                "updateRevision": f"{app}-2",
+            },
+        },
+    )
+    api.add(
+        "controllerrevisions",
+        {
+            "apiVersion": "apps/v1",
+            "kind": "ControllerRevision",
+            "metadata": {"name": f"{app}-1", "namespace": MODEL},
+            "revision": 1,
+            "data": {"spec": {"template": {"metadata": {"labels": labels}}}},
+        },
+    )
+    # the departed units' pods are gone, their status objects are left behind
+    pods = [f"{app}-{unit}" for unit in range(args.units + args.departed_units)]
+    for pod in pods[: args.units]:
+        api.add(
+            "pods",
+            {
+                "apiVersion": "v1",
+                "kind": "Pod",
+                "metadata": {"name": pod, "namespace": MODEL, "labels": labels},
+            },
+        )
+
+    for i in range(args.crds):
+        api.add(
+            "customresourcedefinitions",
+            crd("bench.example.com", f"Widget{i}", f"widget{i}s", "Namespaced", "v1"),
+        )
+
+    per_constraint, remainder = divmod(
+        args.violations, max(args.constraint_kinds * args.constraints_per_kind, 1)
+    )
+    for i in range(args.constraint_kinds):
+        kind = f"K8sBench{i}"
+        template = kind.lower()
+        api.add(
+            "customresourcedefinitions",
+            crd(CONSTRAINTS_GROUP, kind, template, "Cluster", "v1beta1"),
+        )
+        api.add(
+            "constrainttemplates",
+            {
+                "apiVersion": "templates.gatekeeper.sh/v1",
+                "kind": "ConstraintTemplate",
+                "metadata": {"name": template},
+                "spec": {
+                    "crd": {"spec": {"names": {"kind": kind}}},
+                    "targets": [{"target": "admission.k8s.gatekeeper.sh"}],
+                },
+            },
+        )
+        for pod in pods:
+            api.add(
+                "constrainttemplatepodstatuses",
+                {
+                    "apiVersion": STATUS_API,
+                    "kind": "ConstraintTemplatePodStatus",
+                    "metadata": {
+                        "name": f"{pod}-{template}",
+                        "namespace": MODEL,
+                        "labels": {POD_LABEL: pod, TEMPLATE_LABEL: template},
+                    },
+                    "status": {"observedGeneration": 1},
+                },
+            )
+        for j in range(args.constraints_per_kind):
+            name = f"{template}-{j}"
+            total = per_constraint + (i * args.constraints_per_kind + j < remainder)
+            violations = [
+                {
+                    "enforcementAction": "deny",
+                    "kind": "Pod",
+                    "message": f"Pod violates {kind}",
+                    "name": f"pod-{v}",
+                    "namespace": f"ns-{v % 100}",
+                }
+                for v in range(min(total, args.violations_limit))
+            ]
+            api.add(
+                template,
+                {
+                    "apiVersion": f"{CONSTRAINTS_GROUP}/v1beta1",
+                    "kind": kind,
+                    "metadata": {"name": name},
+                    "spec": {"match": {"kinds": [{"kinds": ["Pod"]}]}},
+                    "status": {"totalViolations": total, "violations": violations},
+                },
+            )
+            for pod in pods:
+                api.add(
+                    "constraintpodstatuses",
+                    {
+                        "apiVersion": STATUS_API,
+                        "kind": "ConstraintPodStatus",
+                        "metadata": {
+                            "name": f"{pod}-{template}-{name}",
+                            "namespace": MODEL,
+                            "labels": {POD_LABEL: pod, CONSTRAINT_LABEL: name},
+                        },
+                        "status": {"observedGeneration": 1},
+                    },
+                )
+
+
+def client_class(api):
+    """A lightkube Client sending its requests to the fake API."""
+
+    class Client(lightkube.Client):
+        def __init__(self, *args, **kwargs):
+            kwargs.setdefault("config", api.config)
+            super().__init__(*args, transport=api, **kwargs)
+
+    return Client
+
+
+def external_data_provider():
+    """A local external data provider, answering each key with its upper case."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):  # noqa: N802
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            keys = body["request"]["keys"]
+            answer = json.dumps(
+                {
+                    "apiVersion": "externaldata.gatekeeper.sh/v1beta1",
+                    "kind": "ProviderResponse",
+                    "response": {
+                        "idempotent": True,
+                        "items": [{"key": key, "value": key.upper()} for key in keys],
+                    },
+                }
+            ).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(answer)))
+            self.end_headers()
+            self.wfile.write(answer)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def fresh_dispatch(harness):
+    """Forget what the charm cached, e.g. its clients, as a new dispatch would."""
+    for name, attr in inspect.getmembers(type(harness.charm)):
+        if isinstance(attr, cached_property):
+            harness.charm.__dict__.pop(name, None)
+
+
+def run_steps(harness, api):
+    """Run each step, yielding its name, duration, requests and outcome."""
+    container = next(iter(harness.model.unit.containers))
+    actions = yaml.safe_load((CHARM_DIR / "actions.yaml").read_text())
+    # parameters of the actions, naming seeded objects
+    params = {
+        "constraint": "k8sbench0-0",
+        "constraint-template": "K8sBench0",
+        "keys": "nginx busybox",
+        "provider": "bench",
+    }
+
+    steps = [
+        ("install", harness.begin_with_initial_hooks),
+        ("pebble-ready", partial(harness.container_pebble_ready, container)),
+        ("update-status", lambda: harness.charm.on.update_status.emit()),
+    ]
+    for action, spec in actions.items():
+        action_params = {key: params[key] for key in spec.get("params", {})}
+        steps.append((action, partial(harness.run_action, action, action_params)))
+
+    for index, (name, step) in enumerate(steps):
+        if index:
+            fresh_dispatch(harness)
+        before = api.requests.copy()
+        started = time.perf_counter()
+        try:
+            output = step()
+        except ActionFailed as e:
+            outcome = f"failed: {e.message}"
+        except Exception as e:
+            logging.exception(f"{name} raised")
+            outcome = f"error: {type(e).__name__}: {e}"
+        else:
+            if name in actions:
+                outcome = f"results: {', '.join(sorted(output.results)) or 'none'}"
+            else:
+                status = harness.model.unit.status
+                outcome = f"{status.name}: {status.message}".rstrip(": ")
+        duration = time.perf_counter() - started
+        yield name, duration, api.requests - before, outcome
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--constraint-kinds", type=int, default=100)
+    parser.add_argument("--constraints-per-kind", type=int, default=1)
+    parser.add_argument("--violations", type=int, default=5000)
+    parser.add_argument(
+        "--violations-limit",
+        type=int,
+        default=20,
+        help="violations listed in a constraint's status (default: %(default)s)",
+    )
+    parser.add_argument("--crds", type=int, default=60, help="unrelated CRDs")
+    parser.add_argument("--units", type=int, default=3)
+    parser.add_argument(
+        "--departed-units",
+        type=int,
+        default=1,
+        help="removed units whose pod statuses are left (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="milliseconds per API request"
+    )
+    parser.add_argument("--api-qps", type=float, default=0.0)
+    parser.add_argument("--api-burst", type=int, default=30)
+    parser.add_argument(
+        "--detail", action="store_true", help="list the requests by resource"
+    )
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level)
+
+    # the manifests are found relative to the charm's directory
+    os.chdir(CHARM_DIR)
+    charm_class = next(
+        obj
+        for obj in vars(charm).values()
+        if inspect.isclass(obj)
+        and issubclass(obj, CharmBase)
+        and obj.__module__ == charm.__name__
+    )
+    app = yaml.safe_load((CHARM_DIR / "metadata.yaml").read_text())["name"]
+    # the clients default to the namespace of the pod, as in the cluster
+    api = FakeKube(latency=args.latency / 1e3, namespace=MODEL)
+    seed(api, app, args)
+    provider = external_data_provider()
+
+    harness = Harness(charm_class)
+    harness.set_model_name(MODEL)
+    harness.set_leader(True)
+    harness.add_network("10.1.2.3")
+    harness.update_config(
+        {
+            "api-qps": args.api_qps,
+            "api-burst": args.api_burst,
+            "external-data-providers": yaml.safe_dump(
+                {"bench": {"url": f"http://127.0.0.1:{provider.server_port}/"}}
+            ),
+        }
+    )
+
+    Client = client_class(api)
+    print(
+        f"{charm_class.__name__}: {args.constraint_kinds} constraint kinds, "
+        f"{args.constraint_kinds * args.constraints_per_kind} constraints, "
+        f"{args.violations} violations, {args.crds} other CRDs, "
+        f"{args.units} units, {args.latency} ms per request"
+    )
+    print(f"  {'step':<22} {'ms':>9} {'requests':>9}  outcome")
+    service_patch = "charms.observability_libs.v1.kubernetes_service_patch"
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(mock.patch("lightkube.Client", Client))
+        stack.enter_context(mock.patch("ops.manifests.manifest.Client", Client))
+        stack.enter_context(mock.patch(f"{service_patch}.Client", Client))
+        # read from the pod's service account under Juju
+        stack.enter_context(
+            mock.patch(f"{service_patch}.KubernetesServicePatch._namespace", MODEL)
+        )
+        for name, duration, requests, outcome in run_steps(harness, api):
+            verbs = Counter()
+            for (verb, _), count in requests.items():
+                verbs[verb] += count
+            print(
+                f"  {name:<22} {duration * 1e3:>9.1f} {sum(verbs.values()):>9}  "
+                f"{outcome[:60]}"
+            )
+            if verbs:
+                print(f"  {'':<42}{', '.join(f'{v} {n}' for v, n in verbs.items())}")
+            if args.detail:
+                for (verb, resource), count in sorted(requests.items()):
+                    print(f"  {'':<44}{verb} {resource}: {count}")
+    provider.shutdown()
+
+
+if __name__ == "__main__":
+    main()
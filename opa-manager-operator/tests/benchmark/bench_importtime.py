@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+"""Import-time budget of the charm's dispatches.
+
+Dispatches config-changed on the leader, update-status on the leader and on a
+non-leader with gatekeeper running, and update-status on a non-leader with
+gatekeeper stopped, the way Juju does. The dispatches run from a copy of the
+charm with stand-ins for the hook tools, a `FakeKube` served over HTTP and a
+fake Pebble for each container, under `python -X importtime`. Each dispatch
+runs once before it is measured, which compiles the bytecode and, for
+config-changed, applies the manifests and the Pebble layer. It fails when the
+modules a dispatch imports take longer than its budget, or when a dispatch
+imports a module which only the handlers of other events need:
+
+    tox -e importtime -- --budget 300 --api-budget 900 --libs-budget 1500
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from pathlib import Path
+from socketserver import ThreadingUnixStreamServer
+from typing import List
+from urllib.parse import parse_qs, urlparse
+
+import yaml
+from fake_kube import FakeKube, serve
+
+CHARM_DIR = Path(__file__).resolve().parents[2]
+CHARM_FILES = ("src", "lib", "upstream", "metadata.yaml", "config.yaml", "actions.yaml")
+MODEL = "bench"
+# Modules the dispatches without the libraries don't import
+LIBS = (
+    "charms.observability_libs.v1.kubernetes_service_patch",
+    "charms.prometheus_k8s.v0.prometheus_scrape",
+)
+# Modules an update-status with gatekeeper stopped doesn't import either
+HEAVY = LIBS + ("httpx", "lightkube", "manifests", "ops.manifests")
+HOOK_TOOLS = (
+    "action-get",
+    "action-log",
+    "action-set",
+    "application-version-set",
+    "config-get",
+    "goal-state",
+    "is-leader",
+    "juju-log",
+    "network-get",
+    "relation-get",
+    "relation-ids",
+    "relation-list",
+    "relation-set",
+    "status-get",
+    "status-set",
+)
+HOOK_TOOL = """#!/bin/sh
+case "${0##*/}" in
+    is-leader) echo "$BENCH_LEADER" ;;
+    config-get) cat "$BENCH_CONFIG" ;;
+    juju-log) echo "$@" >>"$BENCH_LOG" ;;
+    relation-ids|relation-list) echo '[]' ;;
+esac
+"""
+# The name, JUJU_DISPATCH_PATH and leadership of each dispatch, whether
+# gatekeeper runs, the modules it mustn't import and its budget option. The
+# leader's config-changed runs first, installing the manifests.
+DISPATCHES = (
+    ("config-changed on the leader", "hooks/config-changed", True, True, (), "libs"),
+    ("update-status on the leader", "hooks/update-status", True, True, LIBS, "api"),
+    ("update-status on a non-leader", "hooks/update-status", False, True, LIBS, "api"),
+    (
+        "update-status on a non-leader, gatekeeper stopped",
+        "hooks/update-status",
+        False,
+        False,
+        HEAVY,
+        "budget",
+    ),
+)
+# Connects the charm to the fake Pebble of its containers, under $BENCH_PEBBLE
+# rather than /charm. ops.model is imported by every dispatch anyway.
+WITH_PEBBLE = """
+import os
+import runpy
+
+from ops import model
+
+get_pebble = model._ModelBackend.get_pebble
+model._ModelBackend.get_pebble = lambda self, path: get_pebble(
+    self, os.environ["BENCH_PEBBLE"] + path
+)
+"""
+# Sets the namespace the service patch reads from the pod's service account
+# under Juju, for the dispatches importing the libraries
+WITH_SERVICE_PATCH = f"""
+from charms.observability_libs.v1 import kubernetes_service_patch
+
+kubernetes_service_patch.KubernetesServicePatch._namespace = {MODEL!r}
+"""
+RUN_CHARM = """
+runpy.run_path("src/charm.py", run_name="__main__")
+"""
+IMPORT_TIME = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$")
+
+
+class FakePebble(BaseHTTPRequestHandler):
+    """Pebble of a container whose services all run, keeping the layers added."""
+
+    def _respond(self, result, status=200, change=None):
+        body = {"type": "sync", "status-code": status, "status": "OK", "result": result}
+        if change:
+            body = {"type": "async", "status-code": 202, "status": "Accepted"}
+            body.update(change=change, result=None)
+        content = json.dumps(body).encode()
+        self.send_response(body["status-code"])
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):  # noqa: N802
+        url = urlparse(self.path)
+        plan = self.server.plan
+        if url.path == "/v1/plan":
+            self._respond(yaml.safe_dump(plan))
+        elif url.path == "/v1/services":
+            names = parse_qs(url.query).get("names", [",".join(plan["services"])])
+            services = [
+                {"name": name, "startup": "enabled", "current": "active"}
+                for name in names[0].split(",")
+                if name
+            ]
+            self._respond(services)
+        elif url.path == "/v1/system-info":
+            self._respond({"version": "1.10.0"})
+        elif url.path == "/v1/checks":
+            self._respond([])
+        elif url.path.startswith("/v1/changes/"):
+            self._respond(
+                {
+                    "id": "1",
+                    "kind": "restart",
+                    "summary": "",
+                    "status": "Done",
+                    "ready": True,
+                    "spawn-time": "2024-01-01T00:00:00Z",
+                    "ready-time": "2024-01-01T00:00:00Z",
+                    "tasks": [],
+                }
+            )
+        else:
+            self._respond({"message": f"{url.path} not found"}, 404)
+
+    def _read_chunked(self) -> bytes:
+        body = b""
+        while size := int(self.rfile.readline(), 16):
+            body += self.rfile.read(size)
+            self.rfile.readline()
+        self.rfile.readline()
+        return body
+
+    def do_POST(self):  # noqa: N802
+        url = urlparse(self.path)
+        if url.path == "/v1/files":  # a push, whose request is the first part
+            request = self._read_chunked().split(b"\r\n\r\n", 1)[1].split(b"\r\n--")[0]
+            files = json.loads(request)["files"]
+            self._respond([{"path": file["path"]} for file in files])
+            return
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if url.path == "/v1/layers":
+            layer = yaml.safe_load(body["layer"])
+            self.server.plan["services"].update(layer.get("services") or {})
+            self._respond(True)
+        elif url.path == "/v1/services":
+            self._respond(None, change="1")
+        else:
+            self._respond({"message": f"{url.path} not found"}, 404)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_pebble(root: Path, containers) -> List[ThreadingUnixStreamServer]:
+    """Serve a fake Pebble for each container, under root as under /charm."""
+    servers = []
+    for container in containers:
+        socket = root / "charm" / "containers" / container / "pebble.socket"
+        socket.parent.mkdir(parents=True)
+        server = ThreadingUnixStreamServer(str(socket), FakePebble)
+        server.plan = {"services": {}}
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    return servers
+
+
+def seed(api: FakeKube, app: str):
+    """Store the objects Juju creates for the application."""
+    labels = {"app.kubernetes.io/name": app}
+    api.add(
+        "statefulsets",
+        {
+            "apiVersion": "apps/v1",
+            "kind": "StatefulSet",
+            "metadata": {"name": app, "namespace": MODEL, "labels": labels},
+            "spec": {
+                "replicas": 1,
+                "selector": {"matchLabels": labels},
+                "serviceName": f"{app}-endpoints",
+                "template": {"metadata": {"labels": labels}},
+            },
+        },
+    )
+
+
+def prepare(workdir: Path, app: str, kubeconfig: str) -> dict:
+    """Copy the charm next to its hook tools, returning the environment to run it in."""
+    charm_dir = workdir / "charm"
+    for name in CHARM_FILES:
+        source = CHARM_DIR / name
+        if source.is_dir():
+            shutil.copytree(source, charm_dir / name)
+        elif source.exists():
+            shutil.copy(source, charm_dir / name)
+
+    tools = workdir / "tools"
+    tools.mkdir()
+    tool = tools / "hook-tool"
+    tool.write_text(HOOK_TOOL)
+    tool.chmod(0o755)
+    for name in HOOK_TOOLS:
+        (tools / name).symlink_to(tool)
+
+    options = yaml.safe_load((CHARM_DIR / "config.yaml").read_text())["options"]
+    config = workdir / "config.json"
+    config.write_text(
+        json.dumps(
+            {key: opt["default"] for key, opt in options.items() if "default" in opt}
+        )
+    )
+    (workdir / "kubeconfig").write_text(kubeconfig)
+    return {
+        "PATH": f"{tools}{os.pathsep}{os.environ['PATH']}",
+        "PYTHONPATH": f"{charm_dir / 'lib'}{os.pathsep}{charm_dir / 'src'}",
+        "BENCH_CONFIG": str(config),
+        "BENCH_LOG": str(workdir / "juju-log"),
+        "KUBECONFIG": str(workdir / "kubeconfig"),
+        "JUJU_CHARM_DIR": str(charm_dir),
+        "JUJU_MODEL_NAME": MODEL,
+        "JUJU_MODEL_UUID": "5f7e5b1c-2b53-4a4e-9d4c-7a1c7c9d6e01",
+        "JUJU_UNIT_NAME": f"{app}/1",
+        "JUJU_VERSION": "3.1.6",
+    }
+
+
+def run(command, env, cwd):
+    """Run the command, returning its wall time and its imports' durations."""
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *command],
+        env=env,
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    wall = time.perf_counter() - started
+    if result.returncode:
+        log = Path(env["BENCH_LOG"])
+        errors = log.read_text().splitlines() if log.exists() else []
+        errors += [
+            line for line in result.stderr.splitlines() if not IMPORT_TIME.match(line)
+        ]
+        sys.exit(f"{' '.join(command)} failed:\n" + "\n".join(errors[-20:]))
+    # the cumulative microseconds of each module, and of the top level imports
+    modules, top = {}, {}
+    for line in result.stderr.splitlines():
+        if match := IMPORT_TIME.match(line):
+            _, cumulative, indent, name = match.groups()
+            modules[name] = int(cumulative)
+            if not indent:
+                top[name] = int(cumulative)
+    return wall, modules, top
+
+
+def measure(name, command, env, cwd, rounds, forbidden):
+    run(command, env, cwd)  # compile the bytecode
+    walls, totals, tops = [], [], {}
+    for _ in range(rounds):
+        wall, modules, top = run(command, env, cwd)
+        walls.append(wall)
+        totals.append(sum(top.values()))
+        for module, cumulative in top.items():
+            tops.setdefault(module, []).append(cumulative)
+    imports_ms = statistics.median(totals) / 1e3
+    print(
+        f"{name}: imports median {imports_ms:7.1f} ms, "
+        f"wall median {statistics.median(walls) * 1e3:7.1f} ms"
+    )
+    slowest = sorted(tops.items(), key=lambda item: -statistics.median(item[1]))[:8]
+    for module, durations in slowest:
+        print(f"  {module:<48} {statistics.median(durations) / 1e3:7.1f} ms")
+    imported = sorted(
+        m for m in modules if any(m == f or m.startswith(f"{f}.") for f in forbidden)
+    )
+    return imports_ms, imported
+
+
+def stop_drift_watcher(workdir: Path):
+    """Stop the drift watcher the leader's dispatches started."""
+    try:
+        os.kill(int((workdir / "drift-watcher.pid").read_text()), signal.SIGTERM)
+    except (OSError, ValueError):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=300.0,
+        help="milliseconds the imports of an update-status with gatekeeper stopped "
+        "may take (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--api-budget",
+        type=float,
+        default=900.0,
+        help="milliseconds the imports of an update-status with gatekeeper running "
+        "may take (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--libs-budget",
+        type=float,
+        default=1500.0,
+        help="milliseconds the imports of a config-changed may take "
+        "(default: %(default)s)",
+    )
+    args = parser.parse_args()
+    budgets = {"budget": args.budget, "api": args.api_budget, "libs": args.libs_budget}
+
+    metadata = yaml.safe_load((CHARM_DIR / "metadata.yaml").read_text())
+    api = FakeKube(namespace=MODEL)
+    seed(api, metadata["name"])
+    server, kubeconfig = serve(api)
+    failures = []
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        env = prepare(workdir, metadata["name"], kubeconfig)
+        env["BENCH_PEBBLE"] = str(workdir / "pebble")
+        pebbles = serve_pebble(workdir / "pebble", metadata["containers"])
+        charm_dir = env["JUJU_CHARM_DIR"]
+        measure("import charm", ["-c", "import charm"], env, charm_dir, args.rounds, ())
+        try:
+            for name, dispatch, leader, running, forbidden, budget in DISPATCHES:
+                dispatch_env = {
+                    **env,
+                    "JUJU_DISPATCH_PATH": dispatch,
+                    "BENCH_LEADER": json.dumps(leader),
+                }
+                command = ["src/charm.py"]
+                if running:
+                    libs = "" if forbidden else WITH_SERVICE_PATCH
+                    command = ["-c", WITH_PEBBLE + libs + RUN_CHARM]
+                imports_ms, imported = measure(
+                    name, command, dispatch_env, charm_dir, args.rounds, forbidden
+                )
+                if imports_ms > budgets[budget]:
+                    failures.append(
+                        f"{name} imports took {imports_ms:.1f} ms, "
+                        f"over {budgets[budget]} ms"
+                    )
+                if imported:
+                    failures.append(f"{name} imported {', '.join(imported)}")
+        finally:
+            stop_drift_watcher(workdir)
+            server.shutdown()
+            for pebble in pebbles:
+                pebble.shutdown()
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
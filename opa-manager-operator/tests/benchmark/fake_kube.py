@@ -0,0 +1,329 @@
+"""In-memory stand-in for the Kubernetes API, as a transport for lightkube.
+
+`FakeKube` answers the requests of a lightkube `Client` from a dict of objects:
+get, list (with label and field selectors and limit/continue pagination),
+create, replace, server-side apply, merge and strategic merge patches, delete
+and deletecollection. CustomResourceDefinitions are ordinary objects, Established
+once stored, so lightkube discovers the custom resources they define the way it
+does in a cluster, by listing them. Every request can be delayed by a fixed
+latency and is counted by verb and resource:
+
+    api = FakeKube(latency=0.005, namespace="gatekeeper")
+    api.add("customresourcedefinitions", crd)
+    client = Client(config=api.config, transport=api, field_manager="bench")
+
+Other processes reach it over HTTP, with the kubeconfig of `serve(api)`.
+"""
+
+import copy
+import itertools
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+import httpx
+import yaml
+from lightkube.config.kubeconfig import KubeConfig
+from lightkube.config.models import Cluster, User
+
+SERVER = "https://fake-kube.local"
+APPLY = "application/apply-patch+yaml"
+JSON_PATCH = "application/json-patch+json"
+SELECTOR = re.compile(
+    r"^(?P<not>!)?(?P<key>[^\s!=]+)"
+    r"(?:\s*(?P<op>==|=|!=)\s*(?P<value>\S*)|\s+(?P<set>in|notin)\s+\((?P<values>[^)]*)\))?$"
+)
+
+Key = Tuple[str, str]  # the API prefix, e.g. apis/apps/v1, and the resource plural
+
+
+def parse_path(path: str) -> Tuple[Key, Optional[str], Optional[str], Optional[str]]:
+    """The resource, namespace, name and subresource of a request path."""
+    parts = path.strip("/").split("/")
+    prefix_length = 2 if parts[0] == "api" else 3
+    prefix, rest = "/".join(parts[:prefix_length]), parts[prefix_length:]
+    namespace = None
+    if rest[0] == "namespaces" and len(rest) > 2:
+        namespace, rest = rest[1], rest[2:]
+    plural, name, subresource = (rest + [None, None])[:3]
+    return (prefix, plural), namespace, name, subresource
+
+
+def label_matches(labels: Dict[str, str], selector: str) -> bool:
+    """Whether labels match a label selector, e.g. "a=b,c in (d,e),!f"."""
+    for term in re.split(r",(?![^(]*\))", selector):
+        match = SELECTOR.match(term.strip())
+        if not match:
+            raise ValueError(f"Invalid label selector {selector!r}")
+        key = match["key"]
+        if match["not"]:
+            found = key not in labels
+        elif match["op"] in ("=", "=="):
+            found = labels.get(key) == match["value"]
+        elif match["op"] == "!=":
+            found = labels.get(key) != match["value"]
+        elif match["set"]:
+            values = {v.strip() for v in match["values"].split(",")}
+            found = (labels.get(key) in values) == (match["set"] == "in")
+        else:
+            found = key in labels
+        if not found:
+            return False
+    return True
+
+
+def field_matches(obj: Dict, selector: str) -> bool:
+    """Whether an object matches a field selector on its metadata."""
+    for term in selector.split(","):
+        field, op, value = re.match(r"^([\w.]+)(==|=|!=)(.*)$", term).groups()
+        section, _, key = field.partition(".")
+        actual = (obj.get(section) or {}).get(key)
+        if (actual == value) != (op != "!="):
+            return False
+    return True
+
+
+def merge(target, patch):
+    """Apply a JSON merge patch, ignoring strategic merge directives."""
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    merged = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if key.startswith("$"):
+            continue
+        if value is None:
+            merged.pop(key, None)
+        else:
+            merged[key] = merge(merged.get(key), value)
+    return merged
+
+
+def status(code: int, reason: str, message: str) -> httpx.Response:
+    body = {
+        "kind": "Status",
+        "apiVersion": "v1",
+        "metadata": {},
+        "status": "Success" if code < 400 else "Failure",
+        "message": message,
+        "reason": reason,
+        "code": code,
+    }
+    return httpx.Response(code, json=body)
+
+
+class FakeKube(httpx.BaseTransport):
+    """Kubernetes API server keeping its objects in memory."""
+
+    def __init__(self, latency: float = 0.0, namespace: str = "default"):
+        self.latency = latency
+        self.namespace = namespace
+        self.requests: Counter = Counter()
+        self.config = KubeConfig.from_one(
+            cluster=Cluster(server=SERVER), user=User(token="fake"), namespace=namespace
+        )
+        self._objects: Dict[Key, Dict[Tuple[Optional[str], str], Dict]] = {}
+        self._versions = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def add(self, plural: str, obj: Dict) -> Dict:
+        """Store an object of the resource with the given plural, e.g. pods."""
+        api_version = obj["apiVersion"]
+        prefix = (
+            f"api/{api_version}" if "/" not in api_version else f"apis/{api_version}"
+        )
+        metadata = obj["metadata"]
+        with self._lock:
+            return self._store((prefix, plural), metadata.get("namespace"), obj)
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        if self.latency:
+            time.sleep(self.latency)
+        key, namespace, name, subresource = parse_path(request.url.path)
+        params = {k: v[-1] for k, v in parse_qs(request.url.query.decode()).items()}
+        verb = self._verb(request, name, params)
+        self.requests[verb, key[1]] += 1
+        if verb == "watch":
+            return status(405, "MethodNotAllowed", "Watches aren't supported")
+        body = json.loads(request.content) if request.content else None
+        with self._lock:
+            return getattr(self, f"_{verb}")(
+                key, namespace, name, subresource, params, body, request
+            )
+
+    @staticmethod
+    def _verb(request, name, params) -> str:
+        if params.get("watch") == "true":
+            return "watch"
+        if request.method == "PATCH":
+            if request.headers["Content-Type"] == APPLY:
+                return "apply"
+            return "patch"
+        verbs = {
+            "GET": ("get", "list"),
+            "POST": ("create", "create"),
+            "PUT": ("replace", "replace"),
+            "DELETE": ("delete", "deletecollection"),
+        }
+        return verbs[request.method][0 if name else 1]
+
+    def _select(self, key, namespace, params) -> List[Dict]:
+        selected = []
+        for (ns, _), obj in sorted(self._objects.get(key, {}).items()):
+            if namespace is not None and ns != namespace:
+                continue
+            labels = obj["metadata"].get("labels") or {}
+            if "labelSelector" in params and not label_matches(
+                labels, params["labelSelector"]
+            ):
+                continue
+            if "fieldSelector" in params and not field_matches(
+                obj, params["fieldSelector"]
+            ):
+                continue
+            selected.append(obj)
+        return selected
+
+    def _store(self, key, namespace, obj, existing=None) -> Dict:
+        obj = copy.deepcopy(obj)
+        metadata = obj.setdefault("metadata", {})
+        if namespace is not None:
+            metadata["namespace"] = namespace
+        if existing is None:
+            metadata["uid"] = f"uid-{next(self._versions)}"
+            metadata["creationTimestamp"] = "2024-01-01T00:00:00Z"
+            metadata["generation"] = metadata.get("generation", 1)
+        else:
+            old = existing["metadata"]
+            metadata["uid"] = old["uid"]
+            metadata["creationTimestamp"] = old["creationTimestamp"]
+            changed = obj.get("spec") != existing.get("spec")
+            metadata["generation"] = old.get("generation", 1) + changed
+        metadata["resourceVersion"] = str(next(self._versions))
+        if key[1] == "customresourcedefinitions":
+            # served as soon as they are stored
+            established = {"type": "Established", "status": "True"}
+            obj["status"] = {**(obj.get("status") or {}), "conditions": [established]}
+        self._objects.setdefault(key, {})[namespace, metadata["name"]] = obj
+        return obj
+
+    def _find(self, key, namespace, name) -> Optional[Dict]:
+        return self._objects.get(key, {}).get((namespace, name))
+
+    def _not_found(self, key, name) -> httpx.Response:
+        return status(404, "NotFound", f'{key[1]} "{name}" not found')
+
+    def _get(self, key, namespace, name, subresource, params, body, request):
+        if (obj := self._find(key, namespace, name)) is None:
+            return self._not_found(key, name)
+        return httpx.Response(200, json=obj)
+
+    def _list(self, key, namespace, name, subresource, params, body, request):
+        selected = self._select(key, namespace, params)
+        start = int(params.get("continue") or 0)
+        limit = int(params.get("limit") or 0) or len(selected)
+        end = start + limit
+        metadata = {"resourceVersion": str(next(self._versions))}
+        if end < len(selected):
+            metadata["continue"] = str(end)
+            metadata["remainingItemCount"] = len(selected) - end
+        api_version = key[0].split("/", 1)[1]
+        body = {"apiVersion": api_version, "kind": "List", "metadata": metadata}
+        return httpx.Response(200, json={**body, "items": selected[start:end]})
+
+    def _create(self, key, namespace, name, subresource, params, body, request):
+        name = body["metadata"]["name"]
+        if self._find(key, namespace, name) is not None:
+            return status(409, "AlreadyExists", f'{key[1]} "{name}" already exists')
+        return httpx.Response(201, json=self._store(key, namespace, body))
+
+    def _replace(self, key, namespace, name, subresource, params, body, request):
+        if (existing := self._find(key, namespace, name)) is None:
+            return self._not_found(key, name)
+        if subresource == "status":
+            body = {**existing, "status": body.get("status")}
+        return httpx.Response(200, json=self._store(key, namespace, body, existing))
+
+    def _apply(self, key, namespace, name, subresource, params, body, request):
+        if (existing := self._find(key, namespace, name)) is None:
+            return httpx.Response(201, json=self._store(key, namespace, body))
+        # the applied fields win, the others are kept
+        obj = merge(existing, body)
+        return httpx.Response(200, json=self._store(key, namespace, obj, existing))
+
+    def _patch(self, key, namespace, name, subresource, params, body, request):
+        if request.headers["Content-Type"] == JSON_PATCH:
+            return status(415, "UnsupportedMediaType", "JSON patches aren't supported")
+        if (existing := self._find(key, namespace, name)) is None:
+            return self._not_found(key, name)
+        obj = merge(existing, body)
+        return httpx.Response(200, json=self._store(key, namespace, obj, existing))
+
+    def _delete(self, key, namespace, name, subresource, params, body, request):
+        if self._objects.get(key, {}).pop((namespace, name), None) is None:
+            return self._not_found(key, name)
+        return status(200, "", f'{key[1]} "{name}" deleted')
+
+    def _deletecollection(self, key, namespace, name, subresource, params, body, _):
+        selected = self._select(key, namespace, params)
+        for obj in selected:
+            metadata = obj["metadata"]
+            del self._objects[key][metadata.get("namespace"), metadata["name"]]
+        return status(200, "", f"{len(selected)} {key[1]} deleted")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def _handle(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = httpx.Request(
+            self.command,
+            f"{SERVER}{self.path}",
+            headers=dict(self.headers),
+            content=self.rfile.read(length),
+        )
+        response = self.server.api.handle_request(request)
+        body = response.read()
+        self.send_response(response.status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(api: FakeKube) -> Tuple[ThreadingHTTPServer, str]:
+    """Serve the fake API on a local port, returning the server and its kubeconfig."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    server.api = api
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    config = {
+        "apiVersion": "v1",
+        "kind": "Config",
+        "clusters": [
+            {
+                "name": "fake",
+                "cluster": {"server": f"http://127.0.0.1:{server.server_port}"},
+            }
+        ],
+        "users": [{"name": "fake", "user": {"token": "fake"}}],
+        "contexts": [
+            {
+                "name": "fake",
+                "context": {
+                    "cluster": "fake",
+                    "user": "fake",
+                    "namespace": api.namespace,
+                },
+            }
+        ],
+        "current-context": "fake",
+    }
+    return server, yaml.safe_dump(config)
@@ -57,11 +57,13 @@ async def wait_for_application(model, app_name, status="active", timeout=60):
 async def test_build_and_deploy(ops_test, charm):
     model = ops_test.model
     image = metadata["resources"]["gatekeeper-image"]["upstream-source"]
+    metrics_image = metadata["resources"]["charm-metrics-image"]["upstream-source"]
 
     cmd = (
         f"juju deploy -m {ops_test.model_full_name} "
         f"{charm.resolve()} -n 2 "
         f"--resource gatekeeper-image={image} "
+        f"--resource charm-metrics-image={metrics_image} "
         "--trust"
     )
     await ops_test.run(*shlex.split(cmd), check=True)
@@ -181,12 +183,13 @@ class TestPolicies:
 async def test_upgrade(ops_test, charm):
     model = ops_test.model
     image = metadata["resources"]["gatekeeper-image"]["upstream-source"]
+    metrics_image = metadata["resources"]["charm-metrics-image"]["upstream-source"]
 
     app = model.applications["gatekeeper-controller-manager"]
     log.debug("Refreshing the charm")
     await app.upgrade_charm(
         path=charm.resolve(),
-        resources={"gatekeeper-image": image},
+        resources={"gatekeeper-image": image, "charm-metrics-image": metrics_image},
     )
 
     log.debug("Waiting for the charm to come up")